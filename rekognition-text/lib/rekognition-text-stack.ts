@@ -21,6 +21,15 @@ export class RekognitionTextStack extends cdk.Stack {
       removalPolicy: RemovalPolicy.DESTROY,
     });
 
+    // Caches each image's result by its etag so that re-uploads skip
+    // Rekognition, expired entries are removed by the ttl
+    const cacheTable = new Table(this, "LICENSE_RESULT_CACHE", {
+      partitionKey: { name: "CacheKey", type: AttributeType.STRING },
+      billingMode: BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: "ExpiresAt",
+      removalPolicy: RemovalPolicy.DESTROY,
+    });
+
     // Policies to attach to our lambda
     const initialPolicy: Array<PolicyStatement> = [
       new PolicyStatement({
@@ -38,11 +47,23 @@ export class RekognitionTextStack extends cdk.Stack {
     // lambda
     const lambda = new Function(this, "LICENSE_FUNCTION", {
       runtime: Runtime.PYTHON_3_9,
-      code: Code.fromAsset(path.join(__dirname, "..", "src", "image_lambda")),
+      code: Code.fromAsset(path.join(__dirname, "..", "src", "image_lambda"), {
+        // Bundle pillow for the local prefilter, off unless PREFILTER_MODE is
+        // set to local
+        bundling: {
+          image: Runtime.PYTHON_3_9.bundlingImage,
+          command: [
+            "bash",
+            "-c",
+            "set -euxo pipefail; pip install -r requirements.in -t /asset-output && cp -au . /asset-output",
+          ],
+        },
+      }),
       handler: "lambda.handler",
       initialPolicy: initialPolicy,
       environment: {
         DYNAMODB_TABLE: table.tableName,
+        CACHE_TABLE: cacheTable.tableName,
       },
     });
 
@@ -50,6 +71,7 @@ export class RekognitionTextStack extends cdk.Stack {
     // write permissions for dynamo
     bucket.grantRead(lambda);
     table.grantWriteData(lambda);
+    cacheTable.grantReadWriteData(lambda);
 
     // Add an S3 event to the lambda
     lambda.addEventSource(
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+Checks the image lambda's field extraction against a few text detection
+fixtures shaped like Rekognition's DetectText responses.
+
+    python scripts/check_extraction.py
+"""
+
+__author__ = "Michael Ciccotosto-Camp"
+__version__ = ""
+
+import os
+import importlib.util
+from typing import Any
+
+
+def load_image_lambda() -> Any:
+    # lambda is a keyword, so the module can't be imported by name
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    spec = importlib.util.spec_from_file_location(
+        "image_lambda",
+        os.path.join(
+            os.path.dirname(__file__), "..", "src", "image_lambda", "lambda.py"
+        ),
+    )
+    image_lambda = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(image_lambda)
+    return image_lambda
+
+
+def detection(
+    text: str, detection_type: str, left: float, top: float, confidence: float = 99.0
+) -> dict:
+    return {
+        "DetectedText": text,
+        "Type": detection_type,
+        "Confidence": confidence,
+        "Geometry": {
+            "BoundingBox": {"Left": left, "Top": top, "Width": 0.08, "Height": 0.03}
+        },
+    }
+
+
+def line_and_words(text: str, left: float, top: float) -> list[dict]:
+    # DetectText reports each line and then each of its words again
+    return [detection(text, "LINE", left, top)] + [
+        detection(word, "WORD", left, top, 98.0) for word in text.split()
+    ]
+
+
+def main() -> None:
+    image_lambda = load_image_lambda()
+    values = [
+        ("000 216 222", 0.72, 0.13),
+        ("01.01.90", 0.3, 0.3),
+        ("C", 0.3, 0.5),
+        ("P2", 0.36, 0.5),
+        ("12.03.20", 0.42, 0.5),
+        ("12.03.25", 0.55, 0.5),
+    ]
+    headings = [
+        ("LICENCE NO.", 0.72, 0.08),
+        ("Class", 0.3, 0.45),
+        ("Type", 0.36, 0.45),
+        ("Effective", 0.42, 0.45),
+        ("Expiry", 0.55, 0.45),
+    ]
+    without_headings = [found for value in values for found in line_and_words(*value)]
+    with_headings = without_headings + [
+        detection(text, "LINE", left, top) for text, left, top in headings
+    ]
+    expected = ("000 216 222", "2020-03-12", "2025-03-12", "C", "P2")
+
+    for name, detections in (
+        ("line and word detections", without_headings),
+        ("line and word detections with headings", with_headings),
+    ):
+        fields = image_lambda.extract_license_fields(detections)
+        extracted = tuple(field.value for field in fields)
+        assert extracted == expected, f"{name}: {extracted} != {expected}"
+        print(f"ok  {name}")
+
+    fields = image_lambda.extract_license_fields(line_and_words("12.03.20", 0.4, 0.5))
+    assert fields.license_no is image_lambda.MISSING_FIELD
+    assert fields.effective_date.value == image_lambda.MISSING_VALUE
+    print("ok  missing fields")
+
+
+if __name__ == "__main__":
+    main()
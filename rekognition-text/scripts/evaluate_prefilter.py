@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+Evaluates the image lambda's local prefilter over a labelled folder of images,
+reporting its precision and recall at keeping licenses and the number of
+detect_labels calls it would save.
+
+    pip install -r src/image_lambda/requirements.in boto3
+    python scripts/evaluate_prefilter.py --images ~/scans --env PREFILTER_MIN_ASPECT=1.2
+
+The folder should hold a "license" and an "other" sub folder. Without --images
+a synthetic set of license like cards and other uploads is generated. Passing
+--hash prints the difference hash of every image instead, for use in
+PREFILTER_TEMPLATE_HASHES.
+"""
+
+__author__ = "Michael Ciccotosto-Camp"
+__version__ = ""
+
+import os
+import argparse
+import importlib.util
+import random
+import tempfile
+from collections import Counter
+from typing import Any
+
+from PIL import Image, ImageDraw, ImageFilter
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+LICENSE_DIR = "license"
+OTHER_DIR = "other"
+
+
+def load_image_lambda() -> Any:
+    # lambda is a keyword, so the module can't be imported by name
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.update(env.split("=", 1) for env in ARGS.env)
+    spec = importlib.util.spec_from_file_location(
+        "image_lambda",
+        os.path.join(
+            os.path.dirname(__file__), "..", "src", "image_lambda", "lambda.py"
+        ),
+    )
+    image_lambda = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(image_lambda)
+    return image_lambda
+
+
+def license_card(rng: random.Random) -> Image.Image:
+    # A light card with a photo and rows of dark text, photographed with a
+    # margin around it
+    card = Image.new("RGB", (856, 540), (rng.randint(200, 250),) * 3)
+    draw = ImageDraw.Draw(card)
+    draw.rectangle((40, 120, 260, 420), fill=(120, 100, 90))
+    for row in range(8):
+        top = 110 + row * 45
+        draw.rectangle((300, top, 300 + rng.randint(200, 500), top + 22), fill=20)
+    margin = rng.randint(0, 120)
+    photo = Image.new("RGB", (856 + 2 * margin, 540 + 2 * margin), (90, 80, 70))
+    photo.paste(card, (margin, margin))
+    return photo.rotate(rng.uniform(-5, 5), expand=False).resize(
+        (photo.width * 3 // 2, photo.height * 3 // 2)
+    )
+
+
+def other_upload(rng: random.Random, index: int) -> Image.Image:
+    kind = index % 4
+    if kind == 0:
+        # A square photo
+        return (
+            Image.effect_noise((1080, 1080), 60)
+            .filter(ImageFilter.GaussianBlur(3))
+            .convert("RGB")
+        )
+    if kind == 1:
+        # A phone screenshot
+        return Image.new("RGB", (1080, 1920), (245, 245, 245))
+    if kind == 2:
+        # A small thumbnail
+        return Image.new("RGB", (200, 150), (rng.randint(0, 255),) * 3)
+    # A landscape photo of a sunset, which the prefilter can't tell from a
+    # license
+    return Image.linear_gradient("L").resize((1600, 1200)).convert("RGB")
+
+
+def generate_images(directory: str) -> None:
+    rng = random.Random(ARGS.seed)
+    for label in (LICENSE_DIR, OTHER_DIR):
+        os.makedirs(os.path.join(directory, label))
+    for index in range(ARGS.synthetic):
+        license_card(rng).save(
+            os.path.join(directory, LICENSE_DIR, f"license-{index}.jpg"), quality=85
+        )
+        other_upload(rng, index).save(
+            os.path.join(directory, OTHER_DIR, f"other-{index}.jpg"), quality=85
+        )
+
+
+def image_paths(directory: str) -> list[str]:
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+
+
+def evaluate(image_lambda: Any, directory: str) -> None:
+    decisions: dict[str, Counter] = {}
+    for label in (LICENSE_DIR, OTHER_DIR):
+        decisions[label] = Counter()
+        for path in image_paths(os.path.join(directory, label)):
+            with open(path, "rb") as image_file:
+                decisions[label][image_lambda.prefilter(image_file.read())] += 1
+
+    # A license is kept unless the prefilter rejects it
+    kept_licenses = sum(decisions[LICENSE_DIR].values()) - decisions[LICENSE_DIR][
+        image_lambda.PREFILTER_REJECT
+    ]
+    kept_others = sum(decisions[OTHER_DIR].values()) - decisions[OTHER_DIR][
+        image_lambda.PREFILTER_REJECT
+    ]
+    images = sum(sum(counts.values()) for counts in decisions.values())
+    saved_calls = sum(
+        counts[image_lambda.PREFILTER_REJECT] + counts[image_lambda.PREFILTER_ACCEPT]
+        for counts in decisions.values()
+    )
+
+    print(f"{'':>8} {'reject':>7} {'accept':>7} {'unknown':>8}")
+    for label, counts in decisions.items():
+        print(
+            f"{label:>8} {counts[image_lambda.PREFILTER_REJECT]:>7} "
+            f"{counts[image_lambda.PREFILTER_ACCEPT]:>7} "
+            f"{counts[image_lambda.PREFILTER_UNKNOWN]:>8}"
+        )
+    print(
+        f"precision          "
+        f"{kept_licenses / max(kept_licenses + kept_others, 1):.3f}"
+    )
+    print(
+        f"recall             "
+        f"{kept_licenses / max(sum(decisions[LICENSE_DIR].values()), 1):.3f}"
+    )
+    print(
+        f"detect_labels saved {saved_calls} of {images} "
+        f"({100 * saved_calls / max(images, 1):.1f}%)"
+    )
+
+
+def print_hashes(image_lambda: Any, directory: str) -> None:
+    for root, _, _ in os.walk(directory):
+        for path in image_paths(root):
+            with Image.open(path) as image:
+                print(f"{image_lambda.difference_hash(image):016x} {path}")
+
+
+def main() -> None:
+    image_lambda = load_image_lambda()
+    with tempfile.TemporaryDirectory() as directory:
+        if not ARGS.images:
+            generate_images(directory)
+        if ARGS.hash:
+            print_hashes(image_lambda, ARGS.images or directory)
+        else:
+            evaluate(image_lambda, ARGS.images or directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", help="folder of license and other images")
+    parser.add_argument("--synthetic", type=int, default=20)
+    parser.add_argument("--hash", action="store_true")
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="prefilter setting for the lambda, may be repeated",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    ARGS = parser.parse_args()
+    main()
@@ -1,107 +1,634 @@
+import io
 import os
 import re
 import json
 import logging
+import math
+import random
+import threading
+import time
 import boto3
-from typing import Final
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final, NamedTuple, Optional
 from datetime import datetime
 
+from botocore.config import Config
 from botocore.utils import ClientError
 
-dynamodb_client = boto3.client("dynamodb")
-rekognition_client = boto3.client("rekognition")
+try:
+    from PIL import Image
+except ImportError:
+    # The prefilter is skipped when pillow has not been bundled
+    Image = None
 
 TABLE_NAME: Final[str] = os.environ.get("DYNAMODB_TABLE") or ""
-LICENSE_NO_RE: Final[re.Pattern] = re.compile("[0-9]{3} [0-9]{3} [0-9]{3}")
-DATE_RE: Final[re.Pattern] = re.compile("[0-9]{2}.[0-9]{2}.[0-9]{2}")
+# "serial" handles one record at a time, "concurrent" makes the rekognition
+# calls for every record in parallel and batches the dynamodb writes
+SERIAL_PROCESSING_MODE: Final[str] = "serial"
+CONCURRENT_PROCESSING_MODE: Final[str] = "concurrent"
+PROCESSING_MODE: Final[str] = (
+    os.environ.get("PROCESSING_MODE") or SERIAL_PROCESSING_MODE
+).lower()
+MAX_WORKERS: Final[int] = int(os.environ.get("MAX_WORKERS") or 8)
+DYNAMODB_MAX_BATCH_SIZE: Final[int] = 25
+BATCH_WRITE_ATTEMPTS: Final[int] = 5
+# "off" sends every image to detect_labels, "local" first checks the image's
+# shape and contrast and rejects the ones that can't be a license
+OFF_PREFILTER_MODE: Final[str] = "off"
+LOCAL_PREFILTER_MODE: Final[str] = "local"
+PREFILTER_MODE: Final[str] = (
+    os.environ.get("PREFILTER_MODE") or OFF_PREFILTER_MODE
+).lower()
+PREFILTER_MIN_SIDE: Final[int] = int(os.environ.get("PREFILTER_MIN_SIDE") or 300)
+# A license card is 85.6mm by 54mm, about 1.59 to 1
+PREFILTER_MIN_ASPECT: Final[float] = float(
+    os.environ.get("PREFILTER_MIN_ASPECT") or 1.1
+)
+PREFILTER_MAX_ASPECT: Final[float] = float(
+    os.environ.get("PREFILTER_MAX_ASPECT") or 2.2
+)
+# The difference between the 5th and 95th percentile of the grey levels, text
+# on a card is never close to uniform
+PREFILTER_MIN_CONTRAST: Final[int] = int(
+    os.environ.get("PREFILTER_MIN_CONTRAST") or 64
+)
+# Comma separated 64 bit difference hashes of known license templates, an image
+# close enough to one of these skips detect_labels entirely
+PREFILTER_TEMPLATE_HASHES: Final[list[int]] = [
+    int(template_hash, 16)
+    for template_hash in (os.environ.get("PREFILTER_TEMPLATE_HASHES") or "").split(",")
+    if template_hash.strip()
+]
+PREFILTER_HASH_DISTANCE: Final[int] = int(
+    os.environ.get("PREFILTER_HASH_DISTANCE") or 10
+)
+PREFILTER_REJECT: Final[str] = "reject"
+PREFILTER_ACCEPT: Final[str] = "accept"
+PREFILTER_UNKNOWN: Final[str] = "unknown"
+LICENSE_LABEL: Final[str] = "Drivers License"
+# Rekognition confidences are percentages
+LICENSE_MIN_CONFIDENCE: Final[float] = 70
+# Full rekognition payloads are only logged at DEBUG, or at INFO for a sample
+# of LOG_SAMPLE_RATE of the invocations, and cut short after
+# LOG_PAYLOAD_MAX_CHARS characters, 0 for no limit
+LOG_LEVEL: Final[str] = (os.environ.get("LOG_LEVEL") or "INFO").upper()
+LOG_SAMPLE_RATE: Final[float] = float(os.environ.get("LOG_SAMPLE_RATE") or 0)
+LOG_PAYLOAD_MAX_CHARS: Final[int] = int(
+    os.environ.get("LOG_PAYLOAD_MAX_CHARS") or 4096
+)
+# An optional dynamodb table, with a "CacheKey" string partition key and ttl on
+# "ExpiresAt", caching each image's result by its etag and size
+CACHE_TABLE_NAME: Final[str] = os.environ.get("CACHE_TABLE") or ""
+CACHE_TTL_SECONDS: Final[int] = int(os.environ.get("CACHE_TTL_SECONDS") or 604800)
+# The results kept in memory between warm invocations
+CACHE_LRU_SIZE: Final[int] = int(os.environ.get("CACHE_LRU_SIZE") or 1024)
+
+# Give every worker thread its own connection
+client_config = Config(max_pool_connections=max(MAX_WORKERS, 10))
+dynamodb_client = boto3.client("dynamodb", config=client_config)
+rekognition_client = boto3.client("rekognition", config=client_config)
+s3_client = boto3.client("s3", config=client_config)
+
+LICENSE_NO_FIELD: Final[str] = "license_no"
+DATE_FIELD: Final[str] = "date"
+EFFECTIVE_DATE_FIELD: Final[str] = "effective_date"
+EXPIRY_DATE_FIELD: Final[str] = "expiry_date"
+CLASS_FIELD: Final[str] = "license_class"
+TYPE_FIELD: Final[str] = "license_type"
+# One pattern for every free form field, the matching group names the field
+FIELD_RE: Final[re.Pattern] = re.compile(
+    rf"(?P<{LICENSE_NO_FIELD}>[0-9]{{3}} [0-9]{{3}} [0-9]{{3}})"
+    rf"|(?P<{DATE_FIELD}>[0-9]{{2}}[./-][0-9]{{2}}[./-][0-9]{{2}})"
+)
+DATE_SEPARATOR_RE: Final[re.Pattern] = re.compile("[./-]")
+LICENSE_CLASSES: Final[frozenset[str]] = frozenset(
+    {"C", "CA", "R", "RE", "LR", "MR", "HR", "HC", "MC"}
+)
+LICENSE_TYPES: Final[frozenset[str]] = frozenset({"L", "P1", "P2", "O"})
+# The fields whose values are a fixed set of codes, keyed by code
+CODE_FIELDS: Final[dict[str, str]] = {
+    **{license_class: CLASS_FIELD for license_class in LICENSE_CLASSES},
+    **{license_type: TYPE_FIELD for license_type in LICENSE_TYPES},
+}
+# The headings printed above each field on the card
+HEADING_FIELDS: Final[dict[str, str]] = {
+    "LICENCE NO": LICENSE_NO_FIELD,
+    "LICENSE NO": LICENSE_NO_FIELD,
+    "EFFECTIVE": EFFECTIVE_DATE_FIELD,
+    "EXPIRY": EXPIRY_DATE_FIELD,
+    "CLASS": CLASS_FIELD,
+    "TYPE": TYPE_FIELD,
+}
+MISSING_VALUE: Final[str] = "NA"
+
+
+class LazyJson:
+    """
+    Defers serialising a payload for a log record until the record is emitted,
+    truncating it to LOG_PAYLOAD_MAX_CHARS.
+    """
+
+    def __init__(self, payload: object) -> None:
+        self._payload = payload
+
+    def __str__(self) -> str:
+        serialised = json.dumps(self._payload, default=str)
+        if LOG_PAYLOAD_MAX_CHARS and len(serialised) > LOG_PAYLOAD_MAX_CHARS:
+            truncated = len(serialised) - LOG_PAYLOAD_MAX_CHARS
+            return f"{serialised[:LOG_PAYLOAD_MAX_CHARS]}...({truncated} more)"
+        return serialised
+
+
+# Set for the invocations sampled to log their payloads at INFO
+payload_sampled = threading.Event()
+
+
+def log_payload(logger: logging.Logger, message: str, payload: object) -> None:
+    level = logging.INFO if payload_sampled.is_set() else logging.DEBUG
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s", message, LazyJson(payload))
 
 
 def is_license(labels: dict) -> bool:
-    all_labels: list[tuple[str, float]] = list(
-        [(str(label["Name"]), float(label["Confidence"])) for label in labels["Labels"]]
+    return any(
+        str(label["Name"]) == LICENSE_LABEL
+        and float(label["Confidence"]) >= LICENSE_MIN_CONFIDENCE
+        for label in labels["Labels"]
     )
-    filtered_labels = filter(lambda x: x[0] == "Drivers License", all_labels)
-    # Only select labels with a big enough threshold
-    filtered_labels = filter(lambda x: x[1] > 0.7, all_labels)
-    return len(list(filtered_labels)) > 0
 
 
-def get_license_no(labels: list[str]) -> str:
-    return next(label for label in labels if LICENSE_NO_RE.match(label))
+def difference_hash(image: "Image.Image") -> int:
+    # Whether each pixel of a 9x8 thumbnail is brighter than its neighbour
+    pixels = image.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            left, right = pixels[row * 9 + column], pixels[row * 9 + column + 1]
+            bits = bits << 1 | (left > right)
+    return bits
 
 
-def get_effective_expiry(labels: list[str]) -> tuple[str, str]:
-    date_str1, date_str2, *_ = [label for label in labels if DATE_RE.match(label)]
-    # Convert to datetime objects
-    date_format: str = r"%d.%m.%y"
-    datetime1: datetime = datetime.strptime(date_str1, date_format)
-    datetime2: datetime = datetime.strptime(date_str2, date_format)
-    return tuple(date.isoformat() for date in sorted([datetime1, datetime2]))
+def grey_contrast(image: "Image.Image") -> int:
+    histogram = image.convert("L").resize((64, 64)).histogram()
+    total = sum(histogram)
+    seen = 0
+    low = high = None
+    for level, count in enumerate(histogram):
+        seen += count
+        if low is None and seen >= total * 0.05:
+            low = level
+        if seen >= total * 0.95:
+            high = level
+            break
+    return high - low
 
 
-def get_license_type(labels: list[str]) -> str:
-    LICENSE_CLASSES: set[str] = {"L", "P1", "P2", "O"}
-    for label in labels:
-        if label.upper() in LICENSE_CLASSES:
-            return label
-    return "NA"
+def prefilter(image_data: bytes) -> str:
+    image = Image.open(io.BytesIO(image_data))
+    width, height = image.size
+    aspect = max(width, height) / max(min(width, height), 1)
+    if (
+        min(width, height) < PREFILTER_MIN_SIDE
+        or not PREFILTER_MIN_ASPECT <= aspect <= PREFILTER_MAX_ASPECT
+    ):
+        return PREFILTER_REJECT
+    # Only a small thumbnail is needed, so let jpegs decode at a reduced scale
+    image.draft("RGB", (128, 128))
+    if PREFILTER_TEMPLATE_HASHES:
+        image_hash = difference_hash(image)
+        if any(
+            bin(image_hash ^ template_hash).count("1") <= PREFILTER_HASH_DISTANCE
+            for template_hash in PREFILTER_TEMPLATE_HASHES
+        ):
+            return PREFILTER_ACCEPT
+    if grey_contrast(image) < PREFILTER_MIN_CONTRAST:
+        return PREFILTER_REJECT
+    return PREFILTER_UNKNOWN
 
 
-def get_license_class(labels: list[str]) -> str:
-    LICENSE_TYPES: set[str] = {"C", "CA", "R", "RE", "LR", "MR", "HR", "HC", "MC"}
-    for label in labels:
-        if label.upper() in LICENSE_TYPES:
-            return label
-    return "NA"
+def detect_license(image_id: dict, logger: logging.Logger, summary: dict) -> bool:
+    key = image_id["S3Object"]["Name"]
+    if PREFILTER_MODE == LOCAL_PREFILTER_MODE and Image is not None:
+        image_data = s3_client.get_object(
+            Bucket=image_id["S3Object"]["Bucket"], Key=key
+        )["Body"].read()
+        try:
+            decision = prefilter(image_data)
+        except (OSError, ValueError) as e:
+            # Leave anything pillow can't read to rekognition
+            logger.warning("Could not prefilter image %s: %s", key, e)
+            decision = PREFILTER_UNKNOWN
+        summary["prefilter"] = decision
+        if decision == PREFILTER_REJECT:
+            # Rejected images never reach rekognition, so make them easy to
+            # find when tuning the thresholds
+            logger.warning("Prefilter rejected image %s.", key)
+        if decision != PREFILTER_UNKNOWN:
+            return decision == PREFILTER_ACCEPT
 
+    label_response: dict = rekognition_client.detect_labels(Image=image_id)
+    log_payload(logger, "label response", label_response)
+    summary["labels"] = len(label_response["Labels"])
+    return is_license(label_response)
 
-def handler(event, context):
-    logger: logging.Logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    logger.info("request: " + json.dumps(event))
 
-    if not TABLE_NAME:
-        message = "Could not find table name from environemnt."
-        logger.error(message)
-        return {"statusCode": 500, "body": message}
+class ExtractedField(NamedTuple):
+    value: str
+    # The rekognition confidence of the detection the value was read from
+    confidence: float
+
+
+class LicenseFields(NamedTuple):
+    license_no: ExtractedField
+    effective_date: ExtractedField
+    expiry_date: ExtractedField
+    license_class: ExtractedField
+    license_type: ExtractedField
+
+
+class Candidate(NamedTuple):
+    value: str
+    confidence: float
+    # The centre of the detection's bounding box, as a fraction of the image
+    x: float
+    y: float
+
 
+MISSING_FIELD: Final[ExtractedField] = ExtractedField(MISSING_VALUE, 0.0)
+
+
+def to_candidate(detection: dict, value: str) -> Candidate:
+    box = detection.get("Geometry", {}).get("BoundingBox", {})
+    return Candidate(
+        value,
+        float(detection.get("Confidence", 0.0)),
+        float(box.get("Left", 0.0)) + float(box.get("Width", 0.0)) / 2,
+        float(box.get("Top", 0.0)) + float(box.get("Height", 0.0)) / 2,
+    )
+
+
+def parse_date(text: str) -> Optional[str]:
     try:
-        for record in event["Records"]:
-            # Get the S3 bucket object info
-            bucket_name = record["s3"]["bucket"]["name"]
-            key = record["s3"]["object"]["key"]
-            image_id = {
-                "S3Object": {
-                    "Bucket": bucket_name,
-                    "Name": key,
-                }
-            }
+        return (
+            datetime.strptime(DATE_SEPARATOR_RE.sub(".", text), r"%d.%m.%y")
+            .date()
+            .isoformat()
+        )
+    except ValueError:
+        return None
+
+
+def heading_distance(candidate: Candidate, heading: Optional[Candidate]) -> float:
+    # Values are printed below their heading, anything above it is unrelated
+    if heading is None or candidate.y <= heading.y:
+        return math.inf
+    return math.hypot(candidate.x - heading.x, candidate.y - heading.y)
+
+
+def choose(
+    candidates: list[Candidate], heading: Optional[Candidate]
+) -> Optional[Candidate]:
+    # The closest value below the field's heading, or failing that the one
+    # rekognition is most confident in
+    if not candidates:
+        return None
+    return min(
+        candidates,
+        key=lambda candidate: (
+            heading_distance(candidate, heading),
+            -candidate.confidence,
+        ),
+    )
+
+
+def to_field(candidate: Optional[Candidate]) -> ExtractedField:
+    if candidate is None:
+        return MISSING_FIELD
+    return ExtractedField(candidate.value, candidate.confidence)
+
+
+def extract_license_fields(detections: list[dict]) -> LicenseFields:
+    candidates: dict[str, list[Candidate]] = {
+        LICENSE_NO_FIELD: [],
+        DATE_FIELD: [],
+        CLASS_FIELD: [],
+        TYPE_FIELD: [],
+    }
+    headings: dict[str, Candidate] = {}
+    # Classify every detection in a single pass
+    for detection in detections:
+        text = str(detection["DetectedText"]).strip()
+        normalised = text.upper().rstrip(".:")
+        code_field = CODE_FIELDS.get(normalised)
+        if code_field:
+            candidates[code_field].append(to_candidate(detection, normalised))
+            continue
+        heading_field = HEADING_FIELDS.get(normalised)
+        if heading_field:
+            headings[heading_field] = to_candidate(detection, normalised)
+            continue
+        field_match = FIELD_RE.fullmatch(text)
+        if not field_match:
+            continue
+        if field_match.lastgroup == DATE_FIELD:
+            date = parse_date(text)
+            if date:
+                candidates[DATE_FIELD].append(to_candidate(detection, date))
+        else:
+            candidates[LICENSE_NO_FIELD].append(to_candidate(detection, text))
+
+    # Rekognition reports every date twice, once in its LINE and once as a
+    # WORD, so keep one detection of each date for the two fields to differ
+    distinct_dates: dict[str, Candidate] = {}
+    for date in candidates[DATE_FIELD]:
+        if (
+            date.value not in distinct_dates
+            or date.confidence > distinct_dates[date.value].confidence
+        ):
+            distinct_dates[date.value] = date
+    dates = list(distinct_dates.values())
+    if EXPIRY_DATE_FIELD in headings or EFFECTIVE_DATE_FIELD in headings:
+        expiry_date = choose(dates, headings.get(EXPIRY_DATE_FIELD))
+        effective_date = choose(
+            [date for date in dates if date is not expiry_date],
+            headings.get(EFFECTIVE_DATE_FIELD),
+        )
+    else:
+        # Without the headings, the license runs between the two latest dates
+        # as any other date, such as the date of birth, comes before them
+        latest = sorted(dates, key=lambda date: date.value)[-2:]
+        effective_date = latest[0] if len(latest) == 2 else None
+        expiry_date = latest[-1] if latest else None
+
+    return LicenseFields(
+        license_no=to_field(
+            choose(candidates[LICENSE_NO_FIELD], headings.get(LICENSE_NO_FIELD))
+        ),
+        effective_date=to_field(effective_date),
+        expiry_date=to_field(expiry_date),
+        license_class=to_field(
+            choose(candidates[CLASS_FIELD], headings.get(CLASS_FIELD))
+        ),
+        license_type=to_field(choose(candidates[TYPE_FIELD], headings.get(TYPE_FIELD))),
+    )
+
+
+def get_image_id(record: dict) -> dict:
+    # Get the S3 bucket object info
+    return {
+        "S3Object": {
+            "Bucket": record["s3"]["bucket"]["name"],
+            "Name": record["s3"]["object"]["key"],
+        }
+    }
 
-            label_response: dict = rekognition_client.detect_labels(Image=image_id)
-            logger.info(json.dumps(label_response))
 
-            # Skip the image if it is not a license
-            if not is_license(label_response):
-                logger.info(f"Image {key} was not deemed to be a drivers license.")
-                continue
+def get_cache_key(record: dict) -> str:
+    # The same image uploaded again, under any key, has the same etag and size
+    s3_object = record["s3"]["object"]
+    if not s3_object.get("eTag"):
+        return ""
+    return f'{s3_object["eTag"]}:{s3_object.get("size", "")}'
 
-            text_response: dict = rekognition_client.detect_text(Image=image_id)
-            logger.info("text response" + json.dumps(text_response))
-            detections: list[dict] = text_response["TextDetections"]
 
-            # Construct a list of all the detected labels
-            labels: list[str] = [label["DetectedText"] for label in detections]
-            effective_date, expirary_date = get_effective_expiry(labels)
+class ResultCache:
+    """
+    Caches the item, or None when there was nothing to write, extracted from
+    each image in memory and in the cache table.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._items: "OrderedDict[str, Optional[dict]]" = OrderedDict()
+        self._stats: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def _remember(self, cache_key: str, item: Optional[dict]) -> None:
+        with self._lock:
+            self._items[cache_key] = item
+            self._items.move_to_end(cache_key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def get(self, cache_key: str) -> tuple[bool, Optional[dict]]:
+        with self._lock:
+            if cache_key in self._items:
+                self._items.move_to_end(cache_key)
+                self._stats["lruHits"] += 1
+                return True, self._items[cache_key]
+        if CACHE_TABLE_NAME:
+            cached = dynamodb_client.get_item(
+                TableName=CACHE_TABLE_NAME, Key={"CacheKey": {"S": cache_key}}
+            ).get("Item")
+            # Expired items linger until dynamodb gets around to deleting them
+            if cached and int(cached["ExpiresAt"]["N"]) > time.time():
+                item = json.loads(cached["Result"]["S"])
+                self._remember(cache_key, item)
+                with self._lock:
+                    self._stats["tableHits"] += 1
+                return True, item
+        with self._lock:
+            self._stats["misses"] += 1
+        return False, None
+
+    def put(self, cache_key: str, item: Optional[dict]) -> None:
+        self._remember(cache_key, item)
+        if CACHE_TABLE_NAME:
             dynamodb_client.put_item(
-                TableName=TABLE_NAME,
+                TableName=CACHE_TABLE_NAME,
                 Item={
-                    "LicenseNo": {"S": get_license_no(labels)},
-                    "EffectiveDate": {"S": effective_date},
-                    "ExpiraryDate": {"S": expirary_date},
-                    "Class": {"S": get_license_class(labels)},
-                    "Type": {"S": get_license_type(labels)},
+                    "CacheKey": {"S": cache_key},
+                    "Result": {"S": json.dumps(item)},
+                    "ExpiresAt": {"N": str(int(time.time()) + CACHE_TTL_SECONDS)},
                 },
             )
-    except ClientError as e:
+
+    def pop_stats(self) -> Counter:
+        with self._lock:
+            stats, self._stats = self._stats, Counter()
+        return stats
+
+
+result_cache = ResultCache(CACHE_LRU_SIZE)
+
+
+def get_item(text_response: dict) -> Optional[dict]:
+    fields = extract_license_fields(text_response["TextDetections"])
+    if fields.license_no is MISSING_FIELD:
+        # The license number is the table's key
+        return None
+    return {
+        "LicenseNo": {"S": fields.license_no.value},
+        "EffectiveDate": {"S": fields.effective_date.value},
+        "ExpiraryDate": {"S": fields.expiry_date.value},
+        "Class": {"S": fields.license_class.value},
+        "Type": {"S": fields.license_type.value},
+        "Confidence": {
+            "M": {
+                field: {"N": f"{extracted.confidence:.2f}"}
+                for field, extracted in fields._asdict().items()
+            }
+        },
+    }
+
+
+class UnprocessedItemsError(Exception):
+    pass
+
+
+def batch_write_items(items: list[dict]) -> None:
+    # A batch may not hold two writes to the same key, so only the last scan of
+    # each license is kept, as with consecutive put_item calls
+    unique_items = list({item["LicenseNo"]["S"]: item for item in items}.values())
+    for start in range(0, len(unique_items), DYNAMODB_MAX_BATCH_SIZE):
+        request_items = {
+            TABLE_NAME: [
+                {"PutRequest": {"Item": item}}
+                for item in unique_items[start : start + DYNAMODB_MAX_BATCH_SIZE]
+            ]
+        }
+        for attempt in range(BATCH_WRITE_ATTEMPTS):
+            if attempt:
+                # Back off before retrying the writes that were throttled
+                time.sleep(0.05 * 2 ** (attempt - 1))
+            request_items = dynamodb_client.batch_write_item(
+                RequestItems=request_items
+            ).get("UnprocessedItems")
+            if not request_items:
+                break
+        else:
+            raise UnprocessedItemsError(
+                f"{len(request_items[TABLE_NAME])} items were left unprocessed"
+            )
+
+
+class ImageResult(NamedTuple):
+    cache_key: str
+    # The item to write, None when there is nothing to write
+    item: Optional[dict]
+    # Whether the image's result was already cached, and so already written
+    cached: bool
+
+
+def process_image(record: dict, logger: logging.Logger) -> ImageResult:
+    start = time.perf_counter()
+    image_id = get_image_id(record)
+    key = image_id["S3Object"]["Name"]
+    # Logged once per image in place of the full payloads
+    summary: dict = {"key": key}
+    result = analyse_image(record, image_id, logger, summary)
+    summary["elapsedMs"] = round(1000 * (time.perf_counter() - start), 1)
+    logger.info("image %s", LazyJson(summary))
+    return result
+
+
+def analyse_image(
+    record: dict, image_id: dict, logger: logging.Logger, summary: dict
+) -> ImageResult:
+    # Looks up the image's cached result, or else runs it through rekognition
+    key = image_id["S3Object"]["Name"]
+    cache_key = get_cache_key(record)
+    if cache_key:
+        hit, item = result_cache.get(cache_key)
+        summary["cached"] = hit
+        if hit:
+            return ImageResult(cache_key, item, True)
+
+    item = None
+    summary["license"] = detect_license(image_id, logger, summary)
+    # Skip the image if it is not a license
+    if summary["license"]:
+        text_response: dict = rekognition_client.detect_text(Image=image_id)
+        log_payload(logger, "text response", text_response)
+        summary["textDetections"] = len(text_response["TextDetections"])
+        item = get_item(text_response)
+        if not item:
+            logger.warning("Could not find a license number in image %s.", key)
+    return ImageResult(cache_key, item, False)
+
+
+def cache_result(result: ImageResult) -> None:
+    # Only called once the result's item has been written, so that a failed
+    # write is retried rather than skipped as a cache hit
+    if result.cache_key and not result.cached:
+        result_cache.put(result.cache_key, result.item)
+
+
+def process_records_serial(records: list[dict], logger: logging.Logger) -> None:
+    for record in records:
+        result = process_image(record, logger)
+        if result.cached:
+            continue
+        if result.item:
+            dynamodb_client.put_item(TableName=TABLE_NAME, Item=result.item)
+        cache_result(result)
+
+
+def process_records_concurrent(records: list[dict], logger: logging.Logger) -> None:
+    # Each thread makes one image's calls in turn, so an image's detect_text
+    # overlaps with the other images' detect_labels
+    with ThreadPoolExecutor(MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(process_image, record, logger) for record in records
+        ]
+    # One record failing shouldn't lose the licenses found in the others
+    results: list[ImageResult] = []
+    errors: list[Exception] = []
+    for record, future in zip(records, futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(
+                "Could not process image %s: %s", record["s3"]["object"]["key"], e
+            )
+            errors.append(e)
+            continue
+        if not result.cached:
+            results.append(result)
+    batch_write_items([result.item for result in results if result.item])
+    for result in results:
+        cache_result(result)
+    if errors:
+        # Report the first failure as the serial mode would, a retry skips the
+        # records written above as they are now cached
+        raise errors[0]
+
+
+def handler(event, context):
+    start = time.perf_counter()
+    logger: logging.Logger = logging.getLogger(__name__)
+    logger.setLevel(LOG_LEVEL)
+    if random.random() < LOG_SAMPLE_RATE:
+        payload_sampled.set()
+    else:
+        payload_sampled.clear()
+    log_payload(logger, "request", event)
+
+    if not TABLE_NAME:
+        message = "Could not find table name from environemnt."
+        logger.error(message)
+        return {"statusCode": 500, "body": message}
+
+    try:
+        if PROCESSING_MODE == CONCURRENT_PROCESSING_MODE:
+            process_records_concurrent(event["Records"], logger)
+        else:
+            process_records_serial(event["Records"], logger)
+    except (ClientError, UnprocessedItemsError) as e:
         logger.error(e)
         return {"statusCode": 500, "body": str(e)}
+    finally:
+        cache_stats = result_cache.pop_stats()
+        logger.info(
+            "invocation %s",
+            LazyJson(
+                {
+                    "records": len(event.get("Records", [])),
+                    "cacheLruHits": cache_stats["lruHits"],
+                    "cacheTableHits": cache_stats["tableHits"],
+                    "cacheMisses": cache_stats["misses"],
+                    "elapsedMs": round(1000 * (time.perf_counter() - start), 1),
+                }
+            ),
+        )
@@ -169,6 +169,9 @@ export class ServiceStack extends cdk.Stack {
             "sqs:ReceiveMessage",
             "sqs:DeleteMessage",
             "sqs:DeleteMessageBatch",
+            // Allows the workers to extend the visibility of messages they
+            // are still processing
+            "sqs:ChangeMessageVisibility",
           ],
           resources: [iconResizeQueue.queueArn],
         })
@@ -176,7 +179,9 @@ export class ServiceStack extends cdk.Stack {
       iconResizeTaskDefinition.addToTaskRolePolicy(
         new iam.PolicyStatement({
           effect: iam.Effect.ALLOW,
-          actions: ["s3:GetObject", "s3:PutObject"],
+          // ListBucket lets the workers tell a missing deduplicated icon
+          // (404) apart from a denied request (403)
+          actions: ["s3:GetObject", "s3:PutObject", "s3:ListBucket"],
           resources: [
             graphicsBucket.bucketArn,
             graphicsBucket.arnForObjects("*"),
@@ -184,6 +189,20 @@ export class ServiceStack extends cdk.Stack {
         })
       );
 
+      iconResizeTaskDefinition.addToTaskRolePolicy(
+        new iam.PolicyStatement({
+          effect: iam.Effect.ALLOW,
+          // Allows the workers to publish the time taken to process each icon
+          actions: ["cloudwatch:PutMetricData"],
+          resources: ["*"],
+          conditions: {
+            StringEquals: {
+              "cloudwatch:namespace": "Service/ImageResize",
+            },
+          },
+        })
+      );
+
       const iconResizeContainer = iconResizeTaskDefinition.addContainer(
         `iconResizeContainerSize${iconSize}`,
         {
@@ -278,7 +297,7 @@ export class ServiceStack extends cdk.Stack {
     targetMetricComputeLambda.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
-        actions: ["ecs:ListTasks"],
+        actions: ["ecs:ListTasks", "ecs:DescribeServices"],
         resources: ["*"],
         // Condition on the ecs cluster, see:
         // https://docs.aws.amazon.com/AmazonECS/latest/developerguide/security_iam_id-based-policy-examples.html
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Compares the cpu time and peak memory the icon resize worker needs per image
+with a plain Image.thumbnail per size as a baseline, over a corpus of photo
+sized images.
+
+    pip install -r src/icon-resize/requirements.in
+    python scripts/benchmark_resize.py --corpus ~/Pictures --sizes 16,32,64
+
+Without --corpus a set of synthetic jpeg and png photos is generated.
+"""
+
+__author__ = "Michael Ciccotosto-Camp"
+__version__ = ""
+
+import io
+import os
+import sys
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+from typing import Any
+
+from PIL import Image, ImageFilter
+
+ICON_RESIZE_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "icon-resize")
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+# Each size decoded and resized from the source with Image.thumbnail, as the
+# worker did before it rendered several sizes
+THUMBNAIL_BASELINE = "thumbnail"
+# Every size rendered in one pass by the worker's resize_icons
+CASCADE = "cascade"
+
+
+def generate_corpus(directory: str) -> None:
+    for index in range(ARGS.images):
+        # Blurred noise compresses more like a photo than raw noise does
+        image = (
+            Image.effect_noise((ARGS.width, ARGS.height), 40 + index % 40)
+            .filter(ImageFilter.GaussianBlur(2))
+            .convert("RGB")
+        )
+        image_format = "png" if index % 4 == 3 else "jpeg"
+        image.save(os.path.join(directory, f"synthetic-{index}.{image_format}"))
+
+
+def corpus_paths(directory: str) -> list[str]:
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.lower().endswith(PHOTO_EXTENSIONS)
+    ]
+
+
+def peak_rss_kib() -> int:
+    # ru_maxrss survives the exec of a spawned process, so it would report the
+    # parent's peak, whereas VmHWM starts afresh
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(resize_mode: str, sizes: str, paths: list[str]) -> dict[str, Any]:
+    # Runs in a fresh process, reading one photo at a time, so the growth in
+    # peak rss is the most memory any single image needed in this mode
+    os.environ.update({"ICON_SIZES": sizes, "AWS_DEFAULT_REGION": "us-east-1"})
+    sys.path.insert(0, ICON_RESIZE_DIR)
+    import app
+
+    def thumbnail_icons(image_data: bytes) -> None:
+        for size in app.ICON_SIZES:
+            image = Image.open(io.BytesIO(image_data))
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            app.encode_icon(image, size)
+
+    baseline_rss = peak_rss_kib()
+    cpu_times: list[float] = []
+    for path in paths:
+        with open(path, "rb") as photo:
+            image_data = photo.read()
+        start = time.process_time()
+        if resize_mode == THUMBNAIL_BASELINE:
+            thumbnail_icons(image_data)
+        else:
+            app.resize_icons(image_data, app.ICON_SIZES)
+        cpu_times.append(time.process_time() - start)
+    peak_rss = peak_rss_kib()
+    return {"cpuTimes": cpu_times, "peakRssGrowth": peak_rss - baseline_rss}
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        if not ARGS.corpus:
+            generate_corpus(directory)
+        paths = corpus_paths(ARGS.corpus or directory)
+        megapixels = sum(
+            Image.open(path).size[0] * Image.open(path).size[1] for path in paths
+        ) / (len(paths) * 1e6)
+        print(f"{len(paths)} images, {megapixels:.1f} megapixels on average")
+        print(f"{'mode':>9} {'cpu ms/img':>11} {'max ms':>8} {'peak MiB':>9}")
+
+        context = multiprocessing.get_context("spawn")
+        for resize_mode in (THUMBNAIL_BASELINE, CASCADE):
+            with context.Pool(1) as pool:
+                result = pool.apply(measure, (resize_mode, ARGS.sizes, paths))
+            cpu_times = result["cpuTimes"]
+            print(
+                f"{resize_mode:>9} "
+                f"{1000 * sum(cpu_times) / len(cpu_times):>11.1f} "
+                f"{1000 * max(cpu_times):>8.1f} "
+                f"{result['peakRssGrowth'] / 1024:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--corpus", help="directory of photos to resize")
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--sizes", default="64")
+    ARGS = parser.parse_args()
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+Measures how many images per second one icon resize task can process in each
+worker mode, using a local moto server in place of s3 and sqs.
+
+    pip install -r src/icon-resize/requirements.in "moto[server]"
+    python scripts/benchmark_worker.py --images 200 --image-size 1024
+
+Passing --check-redelivery instead checks that a message which fails to
+process becomes visible again once its visibility timeout passes.
+"""
+
+__author__ = "Michael Ciccotosto-Camp"
+__version__ = ""
+
+import io
+import os
+import sys
+import argparse
+import json
+import subprocess
+import time
+import urllib.request
+
+import boto3
+from PIL import Image
+
+BUCKET_NAME = "benchmark-icons"
+QUEUE_NAME = "benchmark-icon-resize"
+
+
+def start_moto_server(port: int) -> subprocess.Popen:
+    # Run moto in its own process so it doesn't compete with the worker for
+    # the GIL
+    server = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/moto-api/")
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The moto server did not start")
+
+
+def generate_image(size: int, seed: int) -> bytes:
+    # Noise keeps the encoded size, and so the decode cost, close to a photo
+    image = Image.effect_noise((size, size), 32 + seed % 64).convert("RGB")
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format="jpeg", quality=90)
+    return image_bytes.getvalue()
+
+
+def send_icon_message(sqs_client, queue_url: str, object_key: str) -> None:
+    # Mimic the s3 event notification delivered through the sns topic
+    sqs_client.send_message(
+        QueueUrl=queue_url,
+        MessageBody=json.dumps(
+            {
+                "Message": json.dumps(
+                    {"Records": [{"s3": {"object": {"key": object_key}}}]}
+                )
+            }
+        ),
+    )
+
+
+def upload_images(s3_client, sqs_client, queue_url: str) -> None:
+    for index in range(ARGS.images):
+        object_key = f"icons/benchmark-{index}.jpg"
+        s3_client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=object_key,
+            Body=generate_image(ARGS.image_size, index),
+        )
+        send_icon_message(sqs_client, queue_url, object_key)
+
+
+def run(app, pipelined: bool) -> float:
+    processed = 0
+    start = time.perf_counter()
+    if pipelined:
+        io_pool, resize_pool = app.create_pools()
+        # Don't count the time taken to start the resize processes
+        list(resize_pool.map(abs, range(app.RESIZE_WORKERS)))
+        start = time.perf_counter()
+    tracker = app.MessageTracker()
+    while processed < ARGS.images:
+        with app.next_icon_messages(tracker) as messages:
+            if pipelined:
+                app.process_messages_pipelined(
+                    messages, tracker, io_pool, resize_pool
+                )
+            else:
+                for message in messages:
+                    for object_key in app.get_object_keys(message):
+                        app.process_icon(object_key)
+                    tracker.ack(message)
+            processed += len(messages)
+    elapsed = time.perf_counter() - start
+    tracker.close()
+    if pipelined:
+        io_pool.shutdown()
+        resize_pool.shutdown()
+    return elapsed
+
+
+def check_redelivery(app, sqs_client, queue_url: str) -> None:
+    # The source doesn't exist, so processing the message fails
+    send_icon_message(sqs_client, queue_url, "icons/missing.jpg")
+    tracker = app.MessageTracker()
+    # Received and tracked as the prefetcher does
+    message = sqs_client.receive_message(
+        QueueUrl=queue_url, VisibilityTimeout=app.VISIBILITY_TIMEOUT, WaitTimeSeconds=5
+    )["Messages"][0]
+    tracker.track([message])
+    app.process_message(message, tracker)
+
+    failed = time.perf_counter()
+    redelivered = []
+    while not redelivered and time.perf_counter() - failed < 3 * app.VISIBILITY_TIMEOUT:
+        redelivered = sqs_client.receive_message(
+            QueueUrl=queue_url, WaitTimeSeconds=1
+        ).get("Messages", [])
+    tracker.close()
+    assert redelivered and redelivered[0]["MessageId"] == message["MessageId"], (
+        f"The failed message was not redelivered within "
+        f"{3 * app.VISIBILITY_TIMEOUT} seconds"
+    )
+    print(
+        f"The failed message was redelivered after "
+        f"{time.perf_counter() - failed:.1f} seconds, with a visibility timeout of "
+        f"{app.VISIBILITY_TIMEOUT} seconds"
+    )
+
+
+def main() -> None:
+    server = start_moto_server(ARGS.port)
+    os.environ.update(
+        {
+            "AWS_ENDPOINT_URL": f"http://127.0.0.1:{ARGS.port}",
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+    )
+    try:
+        s3_client = boto3.client("s3")
+        sqs_client = boto3.client("sqs")
+        s3_client.create_bucket(Bucket=BUCKET_NAME)
+        queue_url = sqs_client.create_queue(QueueName=QUEUE_NAME)["QueueUrl"]
+        os.environ.update(
+            {
+                "SQS_URL": queue_url,
+                "ICON_SIZE": str(ARGS.icon_size),
+                "ICONS_BUCKET_NAME": BUCKET_NAME,
+            }
+        )
+        if ARGS.check_redelivery:
+            # Keep the wait for the redelivery short
+            os.environ["VISIBILITY_TIMEOUT"] = "3"
+        os.environ.update(env.split("=", 1) for env in ARGS.env)
+        sys.path.insert(
+            0, os.path.join(os.path.dirname(__file__), "..", "src", "icon-resize")
+        )
+        import app
+
+        if ARGS.check_redelivery:
+            check_redelivery(app, sqs_client, queue_url)
+            return
+
+        print(f"{'mode':>10} {'seconds':>8} {'images/s':>9}")
+        for pipelined in (False, True):
+            upload_images(s3_client, sqs_client, queue_url)
+            elapsed = run(app, pipelined)
+            mode = (
+                app.PIPELINED_WORKER_MODE if pipelined else app.SEQUENTIAL_WORKER_MODE
+            )
+            print(f"{mode:>10} {elapsed:>8.2f} {ARGS.images / elapsed:>9.1f}")
+    finally:
+        server.kill()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--icon-size", type=int, default=64)
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="environment variable for the worker, may be repeated",
+    )
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--check-redelivery", action="store_true")
+    ARGS = parser.parse_args()
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+Replays a queue trace through a simulated icon resize service scaled by each
+of the metric lambda's metric modes, and compares how quickly they scale up
+and how much they over-provision.
+
+    python scripts/simulate_scaling.py --scenario burst
+    python scripts/simulate_scaling.py --trace queue-depth.csv --recorded-tasks 2
+
+A trace is a csv of "seconds,visible" rows, for example an export of the
+queue's ApproximateNumberOfMessagesVisible metric. Arrivals are reconstructed
+from it assuming --recorded-tasks tasks were processing the queue at the time.
+"""
+
+__author__ = "Michael Ciccotosto-Camp"
+__version__ = ""
+
+import os
+import argparse
+import csv
+import importlib.util
+import math
+import random
+from typing import Any, Callable
+
+TICK_SECONDS = 10
+TARGET_VALUE = 100
+
+
+def load_metric_lambda() -> Any:
+    # lambda is a keyword, so the module can't be imported by name
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ["TASK_SERVICE_RATE"] = str(ARGS.service_rate)
+    spec = importlib.util.spec_from_file_location(
+        "metric_lambda",
+        os.path.join(
+            os.path.dirname(__file__), "..", "src", "metric-lambda", "lambda.py"
+        ),
+    )
+    metric_lambda = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(metric_lambda)
+    return metric_lambda
+
+
+def scenario_arrivals(scenario: str) -> list[float]:
+    # Messages arriving during each tick
+    rng = random.Random(ARGS.seed)
+    ticks = int(ARGS.duration / TICK_SECONDS)
+    base_rate = ARGS.service_rate * 0.5
+    rates: list[float] = []
+    for tick in range(ticks):
+        minutes = tick * TICK_SECONDS / 60
+        if scenario == "burst":
+            # Quiet with a few sudden bursts of uploads
+            rate = base_rate + (6 * ARGS.service_rate if minutes % 30 < 5 else 0)
+        elif scenario == "ramp":
+            rate = base_rate + ARGS.service_rate * 4 * min(minutes / 30, 1)
+        else:
+            # A smooth daily style cycle compressed into an hour
+            rate = base_rate + ARGS.service_rate * 2 * (
+                1 - math.cos(2 * math.pi * minutes / 60)
+            )
+        rates.append(rate)
+    return [rng.gauss(rate, math.sqrt(rate)) * TICK_SECONDS for rate in rates]
+
+
+def trace_arrivals(path: str) -> list[float]:
+    with open(path) as trace:
+        rows = sorted(
+            (float(row[0]), float(row[1]))
+            for row in csv.reader(trace)
+            if row and row[0].replace(".", "", 1).isdigit()
+        )
+    arrivals: list[float] = []
+    processed_rate = ARGS.service_rate * ARGS.recorded_tasks
+    for (previous_time, previous), (current_time, current) in zip(rows, rows[1:]):
+        seconds = current_time - previous_time
+        # While there was a backlog the recorded tasks were processing at their
+        # full rate, so more arrived than the queue grew by
+        processed = min(previous, processed_rate * seconds) if previous else 0
+        arrived = max(current - previous + processed, 0)
+        ticks = max(round(seconds / TICK_SECONDS), 1)
+        arrivals.extend([arrived / ticks] * ticks)
+    return arrivals
+
+
+def simulate(
+    arrivals: list[float], metric_value: Callable[[float, int, int, int], float]
+) -> dict[str, float]:
+    visible = 0.0
+    running = ARGS.min_tasks
+    # Ticks at which requested tasks start processing
+    starting: list[int] = []
+    above = below = 0
+    last_scale_out = last_scale_in = last_empty = -math.inf
+    backlog_since: float | None = None
+    scale_up_latencies: list[float] = []
+    waiting_message_seconds = task_seconds = excess_task_seconds = 0.0
+
+    for tick, arrived in enumerate(arrivals):
+        now = tick * TICK_SECONDS
+        running += sum(1 for start in starting if start == tick)
+        starting = [start for start in starting if start > tick]
+
+        visible += max(arrived, 0)
+        processed = min(visible, ARGS.service_rate * running * TICK_SECONDS)
+        visible -= processed
+        # The number of tasks busy processing, each holding a message in flight
+        in_flight = round(processed / (ARGS.service_rate * TICK_SECONDS))
+
+        waiting_message_seconds += visible * TICK_SECONDS
+        task_seconds += running * TICK_SECONDS
+        needed = math.ceil(max(arrived, 0) / (ARGS.service_rate * TICK_SECONDS))
+        if not visible:
+            excess_task_seconds += max(running - max(needed, 1), 0) * TICK_SECONDS
+
+        if not visible:
+            last_empty = now
+        if visible > ARGS.backlog_threshold and backlog_since is None:
+            backlog_since = now
+            if last_scale_out > last_empty:
+                # Scaled out while the backlog was building, before it crossed
+                # the threshold
+                scale_up_latencies.append(0)
+                backlog_since = -math.inf
+        elif visible <= ARGS.backlog_threshold:
+            backlog_since = None
+
+        # Target tracking, scaling out after 3 datapoints above the target and
+        # in after 15 below it
+        value = metric_value(now, round(visible), in_flight, running)
+        total = running + len(starting)
+        desired = min(
+            max(math.ceil(running * value / TARGET_VALUE), ARGS.min_tasks),
+            ARGS.max_tasks,
+        )
+        above = above + 1 if desired > total else 0
+        below = below + 1 if desired < total else 0
+        if above >= 3 and now - last_scale_out >= ARGS.scale_out_cooldown:
+            starting.extend(
+                [tick + math.ceil(ARGS.startup_seconds / TICK_SECONDS)]
+                * (desired - total)
+            )
+            last_scale_out = now
+            above = 0
+            if backlog_since is not None and backlog_since > -math.inf:
+                scale_up_latencies.append(now - backlog_since)
+                # Only the first scale out counts until the backlog clears
+                backlog_since = -math.inf
+        elif below >= 15 and now - last_scale_in >= ARGS.scale_in_cooldown:
+            running = max(running - (total - desired), ARGS.min_tasks)
+            last_scale_in = now
+            below = 0
+
+    total_arrivals = sum(max(arrived, 0) for arrived in arrivals)
+    return {
+        "scaleUpLatency": (
+            sum(scale_up_latencies) / len(scale_up_latencies)
+            if scale_up_latencies
+            else math.nan
+        ),
+        "averageWait": waiting_message_seconds / max(total_arrivals, 1),
+        "taskHours": task_seconds / 3600,
+        "overProvisioned": excess_task_seconds / max(task_seconds, 1),
+    }
+
+
+def main() -> None:
+    metric_lambda = load_metric_lambda()
+    arrivals = (
+        trace_arrivals(ARGS.trace) if ARGS.trace else scenario_arrivals(ARGS.scenario)
+    )
+
+    def instantaneous(now: float, visible: int, in_flight: int, tasks: int) -> float:
+        return metric_lambda.get_metric_value(tasks, visible)
+
+    def predictive(now: float, visible: int, in_flight: int, tasks: int) -> float:
+        window = metric_lambda.record_sample(
+            "simulation", metric_lambda.Sample(now, visible, in_flight, tasks)
+        )
+        return metric_lambda.get_predictive_metric_value(window)
+
+    print(
+        f"{'mode':>13} {'scale up s':>11} {'avg wait s':>11} "
+        f"{'task hours':>11} {'over prov':>10}"
+    )
+    for mode, metric_value in (
+        (metric_lambda.INSTANTANEOUS_METRIC_MODE, instantaneous),
+        (metric_lambda.PREDICTIVE_METRIC_MODE, predictive),
+    ):
+        metric_lambda.SAMPLE_WINDOWS.clear()
+        result = simulate(arrivals, metric_value)
+        print(
+            f"{mode:>13} {result['scaleUpLatency']:>11.0f} "
+            f"{result['averageWait']:>11.1f} {result['taskHours']:>11.2f} "
+            f"{100 * result['overProvisioned']:>9.1f}%"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--trace", help="csv of seconds,visible rows")
+    parser.add_argument(
+        "--scenario", choices=("burst", "ramp", "cycle"), default="burst"
+    )
+    parser.add_argument("--duration", type=float, default=2 * 3600, help="seconds")
+    parser.add_argument(
+        "--service-rate",
+        type=float,
+        default=1.0,
+        help="messages each task processes per second",
+    )
+    parser.add_argument("--recorded-tasks", type=int, default=1)
+    parser.add_argument("--min-tasks", type=int, default=1)
+    parser.add_argument("--max-tasks", type=int, default=5)
+    parser.add_argument("--startup-seconds", type=float, default=60)
+    parser.add_argument("--scale-out-cooldown", type=float, default=60)
+    parser.add_argument("--scale-in-cooldown", type=float, default=30)
+    parser.add_argument("--backlog-threshold", type=float, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    ARGS = parser.parse_args()
+    main()
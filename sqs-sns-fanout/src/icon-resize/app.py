@@ -6,21 +6,199 @@ __version__ = ""
 import io
 import os
 import contextlib
+import hashlib
 import json
 import logging
+import multiprocessing
+import queue
+import threading
 import time
-from typing import cast, Generator, Final, TypedDict
+from collections import OrderedDict
+from concurrent.futures import (
+    as_completed,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import cast, Any, Callable, Generator, Final, NamedTuple, TypedDict
 
 import boto3
+from botocore.exceptions import ClientError
 
 from PIL import Image
 
 SQS_URL: Final[str] = os.environ.get("SQS_URL") or ""
 ICON_SIZE: Final[int] = int(os.environ.get("ICON_SIZE") or 0)
+# A comma separated list of sizes to render from a single download and decode
+# of each icon, defaults to just ICON_SIZE. Sizes are rendered largest first.
+ICON_SIZES: Final[tuple[int, ...]] = tuple(
+    sorted(
+        {
+            int(size)
+            for size in (os.environ.get("ICON_SIZES") or str(ICON_SIZE)).split(",")
+            if size.strip() and int(size) > 0
+        },
+        reverse=True,
+    )
+)
+# Smaller sizes are resized from a previously rendered size rather than the
+# source, but only from one at least this many times larger so the repeated
+# resampling doesn't visibly soften the icon
+CASCADE_MIN_RATIO: Final[float] = float(os.environ.get("CASCADE_MIN_RATIO") or 2)
+UPLOAD_WORKERS: Final[int] = int(os.environ.get("UPLOAD_WORKERS") or 8)
+
+# Icons are resized as Image.thumbnail does, decoding jpeg sources at a 1/2, 1/4
+# or 1/8 scale and box reducing to within REDUCING_GAP times the target before
+# the lanczos pass, so the decode is already cut down to the sizes needed
+REDUCING_GAP: Final[float] = 2.0
+
+
+class IconFormat(NamedTuple):
+    pillow_format: str
+    content_type: str
+    extension: str
+
+
+ICON_FORMATS: Final[dict[str, IconFormat]] = {
+    "png": IconFormat("PNG", "image/png", ".png"),
+    "webp": IconFormat("WEBP", "image/webp", ".webp"),
+    "jpeg": IconFormat("JPEG", "image/jpeg", ".jpg"),
+}
+# Icons written in any format other than png have their key's extension
+# swapped to match
+ICON_FORMAT: Final[IconFormat] = ICON_FORMATS[
+    (os.environ.get("ICON_FORMAT") or "png").lower()
+]
+# The zlib level (0-9) for png or the method (0-6) for webp, lower is faster
+ICON_COMPRESS_LEVEL: Final[int | None] = (
+    int(os.environ["ICON_COMPRESS_LEVEL"])
+    if os.environ.get("ICON_COMPRESS_LEVEL")
+    else None
+)
+# The quality (0-100) of webp and jpeg icons
+ICON_QUALITY: Final[int] = int(os.environ.get("ICON_QUALITY") or 85)
+# Png icons no bigger than ICON_PALETTE_MAX_SIZE are quantized to a palette of
+# ICON_PALETTE_COLORS colours, which usually makes them several times smaller
+ICON_PALETTE_MAX_SIZE: Final[int] = int(os.environ.get("ICON_PALETTE_MAX_SIZE") or 0)
+ICON_PALETTE_COLORS: Final[int] = int(os.environ.get("ICON_PALETTE_COLORS") or 256)
+ICON_CACHE_CONTROL: Final[str] = os.environ.get("ICON_CACHE_CONTROL") or ""
+
+# "off" resizes every upload. "etag" looks up previously rendered icons using
+# the source's etag from the s3 event, before downloading it. "content" hashes
+# the downloaded source instead, which also catches identical images uploaded
+# in a different way, but only saves the decode and encode. Rendered icons are
+# kept under DEDUP_PREFIX and copied server side when the same source appears.
+OFF_DEDUP_MODE = "off"
+ETAG_DEDUP_MODE = "etag"
+CONTENT_DEDUP_MODE = "content"
+DEDUP_MODE: Final[str] = (os.environ.get("DEDUP_MODE") or OFF_DEDUP_MODE).lower()
+DEDUP_PREFIX: Final[str] = os.environ.get("DEDUP_PREFIX") or "icons-dedup"
+# The number of rendered icons remembered in process, saving a HEAD request
+DEDUP_LRU_SIZE: Final[int] = int(os.environ.get("DEDUP_LRU_SIZE") or 4096)
+# Changing how icons are rendered must not reuse icons rendered the old way
+RENDER_FINGERPRINT: Final[str] = hashlib.sha256(
+    json.dumps(
+        [
+            REDUCING_GAP,
+            CASCADE_MIN_RATIO,
+            ICON_FORMAT.pillow_format,
+            ICON_COMPRESS_LEVEL,
+            ICON_QUALITY,
+            ICON_PALETTE_MAX_SIZE,
+            ICON_PALETTE_COLORS,
+        ]
+    ).encode()
+).hexdigest()[:12]
 ICONS_BUCKET_NAME: Final[str] = os.environ.get("ICONS_BUCKET_NAME") or ""
 
+# "sequential" processes one icon at a time. "pipelined" fetches and uploads
+# icons on a thread pool while a process pool, one process per cpu of the task's
+# quota, does the resizing so the task's cpu isn't left idle during s3 round
+# trips.
+SEQUENTIAL_WORKER_MODE = "sequential"
+PIPELINED_WORKER_MODE = "pipelined"
+WORKER_MODE: Final[str] = (
+    os.environ.get("WORKER_MODE") or SEQUENTIAL_WORKER_MODE
+).lower()
+IO_WORKERS: Final[int] = int(os.environ.get("IO_WORKERS") or 16)
+
+
+def available_cpus() -> int:
+    # The host's core count says nothing of the task's share of it, a 256 cpu
+    # unit fargate task only gets a quarter of a vcpu, so read the cgroup quota
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+    except OSError:
+        try:
+            # cgroup v1, where an unlimited quota is -1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as cfs_quota:
+                quota = cfs_quota.read().strip().replace("-1", "max")
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as cfs_period:
+                period = cfs_period.read().strip()
+        except OSError:
+            return 1
+    if quota == "max":
+        return len(os.sched_getaffinity(0))
+    return max(int(quota) // int(period), 1)
+
+
+RESIZE_WORKERS: Final[int] = int(os.environ.get("RESIZE_WORKERS") or available_cpus())
+
+# Messages are received with a short visibility timeout which a heartbeat
+# thread keeps extending for as long as the message is being processed, so a
+# failed message is redelivered quickly while a slow one isn't redelivered at
+# all. Messages still in flight after MAX_IN_FLIGHT_SECONDS are given up on.
+VISIBILITY_TIMEOUT: Final[int] = int(os.environ.get("VISIBILITY_TIMEOUT") or 30)
+HEARTBEAT_INTERVAL: Final[float] = float(
+    os.environ.get("HEARTBEAT_INTERVAL") or VISIBILITY_TIMEOUT / 3
+)
+MAX_IN_FLIGHT_SECONDS: Final[float] = float(
+    os.environ.get("MAX_IN_FLIGHT_SECONDS") or 15 * 60
+)
+# The most entries allowed in a single sqs batch request
+SQS_MAX_BATCH_SIZE = 10
+
+# "poll" receives a batch of messages, processes it, then checks the queue
+# length to decide whether to sleep. "prefetch" keeps a local buffer of
+# messages filled by long polling from a background thread, so processing never
+# waits on an sqs round trip and an empty long poll is the only idle signal.
+POLL_CONSUMER_MODE = "poll"
+PREFETCH_CONSUMER_MODE = "prefetch"
+CONSUMER_MODE: Final[str] = (
+    os.environ.get("CONSUMER_MODE") or POLL_CONSUMER_MODE
+).lower()
+# Buffered messages are invisible, so they are missing from the visible count
+# the scaling metric reads. By default each consumer gets just one message
+# waiting for it, one in the sequential mode and one per io thread pipelined.
+PREFETCH_BUFFER_SIZE: Final[int] = max(
+    int(
+        os.environ.get("PREFETCH_BUFFER_SIZE")
+        or (IO_WORKERS if WORKER_MODE == PIPELINED_WORKER_MODE else 1)
+    ),
+    1,
+)
+# The longest wait allowed by sqs long polling
+SQS_MAX_WAIT_SECONDS = 20
+
+# Caps the rate icons are processed at, to simulate slower workers in staging.
+# Disabled when 0, the default.
+RATE_LIMIT_PER_SECOND: Final[float] = float(
+    os.environ.get("RATE_LIMIT_PER_SECOND") or 0
+)
+RATE_LIMIT_BURST: Final[int] = max(int(os.environ.get("RATE_LIMIT_BURST") or 1), 1)
+# How often, in seconds, the time taken to process each icon is published to
+# cloudwatch. Disabled when 0.
+METRIC_INTERVAL: Final[float] = float(os.environ.get("METRIC_INTERVAL") or 60)
+METRIC_NAMESPACE = "Service/ImageResize"
+
 S3_CLIENT: Final = boto3.client("s3")
 SQS_CLIENT: Final = boto3.client("sqs")
+CLOUDWATCH_CLIENT: Final = boto3.client("cloudwatch")
+# Uploads the sizes of an icon in parallel. Kept apart from the io pool, whose
+# threads may all be busy waiting on these uploads.
+UPLOAD_POOL: Final = ThreadPoolExecutor(UPLOAD_WORKERS)
 
 logging.basicConfig(level=logging.INFO)
 logger: logging.Logger = logging.getLogger()
@@ -33,88 +211,628 @@ class SqsMessage(TypedDict):
     ReceiptHandle: str
 
 
+class S3Object(NamedTuple):
+    key: str
+    # Empty when the event didn't include one
+    etag: str
+
+
+class LruSet:
+    """
+    A thread safe set that forgets its least recently used items once it holds
+    more than max_size of them.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._lock = threading.Lock()
+        self._items: OrderedDict[str, None] = OrderedDict()
+        self._max_size = max_size
+
+    def __contains__(self, item: str) -> bool:
+        with self._lock:
+            if item not in self._items:
+                return False
+            self._items.move_to_end(item)
+            return True
+
+    def add(self, item: str) -> None:
+        with self._lock:
+            self._items[item] = None
+            self._items.move_to_end(item)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def discard(self, item: str) -> None:
+        with self._lock:
+            self._items.pop(item, None)
+
+
+RENDERED_ICONS: Final = LruSet(DEDUP_LRU_SIZE)
+
+
+class TokenBucket:
+    """
+    Blocks callers so that on average no more than rate calls to acquire
+    return per second, allowing bursts of up to burst calls.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def acquire(self) -> None:
+        if self._rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._burst, self._tokens + (now - self._updated) * self._rate
+            )
+            self._updated = now
+            # Take the token now, waiting outside of the lock for it to refill
+            # if it was borrowed
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        time.sleep(wait)
+
+
+class ProcessingMetrics:
+    """
+    Collects the time taken to process each icon and periodically publishes
+    them to cloudwatch as a statistic set.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._times: list[float] = []
+        self._started = False
+
+    def record(self, seconds: float) -> None:
+        # Nothing would ever publish the times
+        if not self._started:
+            return
+        with self._lock:
+            self._times.append(seconds)
+
+    def start(self, interval: float) -> None:
+        self._started = True
+        threading.Thread(target=self._run, args=(interval,), daemon=True).start()
+
+    def _run(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self.publish()
+            except Exception:
+                logger.exception("Failed to publish the processing metrics")
+
+    def publish(self) -> None:
+        with self._lock:
+            times, self._times = self._times, []
+        if not times:
+            return
+        dimensions = [
+            {
+                "Name": "IconSize",
+                "Value": "size" + "-".join(str(size) for size in sorted(ICON_SIZES)),
+            }
+        ]
+        CLOUDWATCH_CLIENT.put_metric_data(
+            Namespace=METRIC_NAMESPACE,
+            MetricData=[
+                {
+                    "MetricName": "IconProcessingTime",
+                    "Dimensions": dimensions,
+                    "StatisticValues": {
+                        "SampleCount": len(times),
+                        "Sum": sum(times),
+                        "Minimum": min(times),
+                        "Maximum": max(times),
+                    },
+                    "Unit": "Seconds",
+                },
+                {
+                    "MetricName": "IconsProcessed",
+                    "Dimensions": dimensions,
+                    "Value": len(times),
+                    "Unit": "Count",
+                },
+            ],
+        )
+        logger.info(
+            f"Processed {len(times)} icons taking {sum(times) / len(times):.3f}s "
+            "on average"
+        )
+
+
+RATE_LIMITER: Final = TokenBucket(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+PROCESSING_METRICS: Final = ProcessingMetrics()
+
+
+class MessageTracker:
+    """
+    Keeps the visibility of in flight messages extended from a background
+    thread until each message is acknowledged or released.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Maps each message id to its message and when it was received
+        self._in_flight: dict[str, tuple[SqsMessage, float]] = {}
+        self._stopped = threading.Event()
+        self._heartbeat = threading.Thread(target=self._run, daemon=True)
+        self._heartbeat.start()
+
+    def track(self, messages: list[SqsMessage]) -> None:
+        received = time.monotonic()
+        with self._lock:
+            for message in messages:
+                self._in_flight[message["MessageId"]] = (message, received)
+
+    def ack(self, message: SqsMessage) -> None:
+        # Delete the message as soon as it is done so it can't be redelivered
+        try:
+            SQS_CLIENT.delete_message(
+                QueueUrl=SQS_URL, ReceiptHandle=message["ReceiptHandle"]
+            )
+        except Exception:
+            # Don't let a transient sqs error stop the worker, the message is
+            # redelivered once its visibility timeout passes and its icons are
+            # simply rendered again
+            logger.exception(f"Failed to delete message {message['MessageId']}")
+        finally:
+            self.release([message])
+
+    def release(self, messages: list[SqsMessage]) -> None:
+        # Stop extending the messages, any not yet deleted will become visible
+        # again once their visibility timeout passes
+        with self._lock:
+            for message in messages:
+                self._in_flight.pop(message["MessageId"], None)
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._heartbeat.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.extend()
+            except Exception:
+                logger.exception("Failed to extend the visibility of messages")
+
+    def extend(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                message
+                for message, received in self._in_flight.values()
+                if now - received > MAX_IN_FLIGHT_SECONDS
+            ]
+            for message in expired:
+                logger.warning(f"Giving up on message {message['MessageId']}")
+                del self._in_flight[message["MessageId"]]
+            messages = [message for message, _ in self._in_flight.values()]
+
+        for index in range(0, len(messages), SQS_MAX_BATCH_SIZE):
+            response = SQS_CLIENT.change_message_visibility_batch(
+                QueueUrl=SQS_URL,
+                Entries=[
+                    {
+                        "Id": message["MessageId"],
+                        "ReceiptHandle": message["ReceiptHandle"],
+                        "VisibilityTimeout": VISIBILITY_TIMEOUT,
+                    }
+                    for message in messages[index : index + SQS_MAX_BATCH_SIZE]
+                ],
+            )
+            for failure in response.get("Failed", []):
+                # Most likely the message was acknowledged in the meantime
+                logger.info(
+                    f"Could not extend message {failure['Id']}: {failure['Message']}"
+                )
+
+
 @contextlib.contextmanager
-def next_icon_paths() -> Generator[list[str], None, None]:
+def next_icon_messages(
+    tracker: MessageTracker,
+) -> Generator[list[SqsMessage], None, None]:
 
     sqs_response: dict = SQS_CLIENT.receive_message(
         QueueUrl=SQS_URL,
         MaxNumberOfMessages=5,
         # We can return all of the attributes by specifying All
         MessageAttributeNames=["All"],
-        # Assuming each item takes a maximum time of 15 seconds to complete and
-        # the maximum number of messages we can receive in any one request is 5,
-        # then 5 * 15 is the maximum amount of time we should spend on this
-        # request before making the items visible again due to an internal problem
-        VisibilityTimeout=5 * 15,
+        VisibilityTimeout=VISIBILITY_TIMEOUT,
         WaitTimeSeconds=5,
     )
 
-    object_keys: list[str] = []
     messages = cast(list[SqsMessage], sqs_response.get("Messages", []))
-
-    for message in messages:
-        records = json.loads(json.loads(message["Body"])["Message"])["Records"]
-        for record in records:
-            object_key: str = record["s3"]["object"]["key"]
-            object_keys.append(object_key)
+    tracker.track(messages)
     try:
-        yield object_keys
-    except Exception as e:
-        # We don't want to delete messages if an exception was raised
+        yield messages
+    except Exception:
+        logger.exception("Failed to process icons")
     finally:
-        if messages:
-            SQS_CLIENT.delete_message_batch(
-                QueueUrl=SQS_URL,
-                Entries=[
-                    {"Id": message["MessageId"], "ReceiptHandle": message["ReceiptHandle"]}
-                    for message in messages
-                ],
-            )
+        # Any message that wasn't acknowledged failed and is left for
+        # redelivery
+        tracker.release(messages)
+
+
+class MessagePrefetcher:
+    """
+    Keeps a bounded buffer of received messages topped up from a background
+    thread using long polling.
+    """
+
+    def __init__(self, tracker: MessageTracker, buffer_size: int) -> None:
+        self._tracker = tracker
+        self._buffer: queue.Queue[SqsMessage] = queue.Queue(buffer_size)
+        self._receiver = threading.Thread(target=self._run, daemon=True)
+        self._receiver.start()
+
+    def get(self) -> SqsMessage:
+        return self._buffer.get()
+
+    def _run(self) -> None:
+        idle = False
+        while True:
+            # Only ask for as many messages as there is room for, so messages
+            # aren't held invisible while another task could process them
+            free_slots = self._buffer.maxsize - self._buffer.qsize()
+            if free_slots <= 0:
+                time.sleep(0.05)
+                continue
+            try:
+                sqs_response: dict = SQS_CLIENT.receive_message(
+                    QueueUrl=SQS_URL,
+                    MaxNumberOfMessages=min(free_slots, SQS_MAX_BATCH_SIZE),
+                    MessageAttributeNames=["All"],
+                    VisibilityTimeout=VISIBILITY_TIMEOUT,
+                    WaitTimeSeconds=SQS_MAX_WAIT_SECONDS,
+                )
+            except Exception:
+                logger.exception("Failed to receive messages")
+                time.sleep(1)
+                continue
+
+            messages = cast(list[SqsMessage], sqs_response.get("Messages", []))
+            if not messages and not idle:
+                logger.info("The queue is empty, waiting for more icons")
+            idle = not messages
+            # Buffered messages are tracked so their visibility is extended
+            # while they wait to be processed
+            self._tracker.track(messages)
+            for message in messages:
+                self._buffer.put(message)
+
+
+def get_s3_objects(message: SqsMessage) -> list[S3Object]:
+    records = json.loads(json.loads(message["Body"])["Message"])["Records"]
+    return [
+        S3Object(record["s3"]["object"]["key"], record["s3"]["object"].get("eTag", ""))
+        for record in records
+    ]
+
+
+def get_object_keys(message: SqsMessage) -> list[str]:
+    return [s3_object.key for s3_object in get_s3_objects(message)]
 
 
 def get_resized_object_key(object_key: str, size: int) -> str:
     _, suffix = object_key.split("/", maxsplit=1)
+    if ICON_FORMAT.pillow_format != "PNG":
+        suffix = os.path.splitext(suffix)[0] + ICON_FORMAT.extension
     return "".join([f"icons-size-{size}", "/", suffix])
 
 
-def main() -> None:
-    if not SQS_URL:
-        logger.error("No sqs url set in environment")
+def get_icon(object_key: str) -> bytes:
+    s3_response: dict = S3_CLIENT.get_object(Bucket=ICONS_BUCKET_NAME, Key=object_key)
+    return s3_response["Body"].read()
 
-    if not ICONS_BUCKET_NAME:
-        logger.error("No bucket arn set in environment")
 
-    if not ICON_SIZE:
-        logger.error("No icon size set in environment")
+def get_dedup_key(source_hash: str, size: int) -> str:
+    # Etags are quoted
+    source_hash = source_hash.strip('"')
+    file_name = f"{source_hash}-{size}{ICON_FORMAT.extension}"
+    return "/".join([DEDUP_PREFIX, RENDER_FINGERPRINT, file_name])
+
+
+def is_rendered(dedup_key: str) -> bool:
+    if dedup_key in RENDERED_ICONS:
+        return True
+    try:
+        S3_CLIENT.head_object(Bucket=ICONS_BUCKET_NAME, Key=dedup_key)
+    except ClientError as e:
+        # The task role's s3:ListBucket lets a missing key come back as a 404
+        # rather than a 403, and a HEAD response has no body to carry a
+        # NoSuchKey code
+        if e.response["Error"]["Code"] == "404":
+            return False
+        raise
+    RENDERED_ICONS.add(dedup_key)
+    return True
+
+
+def copy_rendered_icons(object_key: str, source_hash: str) -> tuple[int, ...]:
+    """
+    Copies every size already rendered from an identical source and returns
+    the sizes that still need rendering.
+    """
+    missing: list[int] = []
+    for size in ICON_SIZES:
+        dedup_key = get_dedup_key(source_hash, size)
+        if not is_rendered(dedup_key):
+            missing.append(size)
+            continue
+        try:
+            S3_CLIENT.copy_object(
+                Bucket=ICONS_BUCKET_NAME,
+                Key=get_resized_object_key(object_key, size),
+                CopySource={"Bucket": ICONS_BUCKET_NAME, "Key": dedup_key},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            # The rendered icon was removed since it was seen
+            RENDERED_ICONS.discard(dedup_key)
+            missing.append(size)
+    if len(missing) < len(ICON_SIZES):
+        logger.info(f"Reused {len(ICON_SIZES) - len(missing)} icons of {object_key}")
+    return tuple(missing)
+
+
+def keep_rendered_icons(object_key: str, source_hash: str, sizes: list[int]) -> None:
+    for size in sizes:
+        dedup_key = get_dedup_key(source_hash, size)
+        S3_CLIENT.copy_object(
+            Bucket=ICONS_BUCKET_NAME,
+            Key=dedup_key,
+            CopySource={
+                "Bucket": ICONS_BUCKET_NAME,
+                "Key": get_resized_object_key(object_key, size),
+            },
+        )
+        RENDERED_ICONS.add(dedup_key)
+
+
+def put_icon(object_key: str, size: int, icon_data: bytes) -> None:
+    extra_args = {"CacheControl": ICON_CACHE_CONTROL} if ICON_CACHE_CONTROL else {}
+    S3_CLIENT.put_object(
+        Body=icon_data,
+        Bucket=ICONS_BUCKET_NAME,
+        Key=get_resized_object_key(object_key, size),
+        ContentType=ICON_FORMAT.content_type,
+        **extra_args,
+    )
+
+
+def put_icons(object_key: str, icons: dict[int, bytes]) -> None:
+    if len(icons) == 1:
+        put_icon(object_key, *next(iter(icons.items())))
+        return
+    futures = [
+        UPLOAD_POOL.submit(put_icon, object_key, size, icon_data)
+        for size, icon_data in icons.items()
+    ]
+    for future in futures:
+        future.result()
+
+
+def fit_size(width: int, height: int, size: int) -> tuple[int, int]:
+    # Largest dimensions with the same aspect ratio that fit in a size by size
+    # box, never enlarging the image
+    scale = min(size / width, size / height, 1)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def encode_icon(image: Image.Image, size: int) -> bytes:
+    options: dict[str, Any] = {}
+    if ICON_FORMAT.pillow_format == "PNG":
+        if ICON_COMPRESS_LEVEL is not None:
+            options["compress_level"] = ICON_COMPRESS_LEVEL
+        if size <= ICON_PALETTE_MAX_SIZE and image.mode != "P":
+            image = image.convert("RGBA").quantize(
+                ICON_PALETTE_COLORS, method=Image.Quantize.FASTOCTREE
+            )
+            # Trims the palette down to the colours actually used
+            options["optimize"] = True
+    elif ICON_FORMAT.pillow_format == "WEBP":
+        options["quality"] = ICON_QUALITY
+        if ICON_COMPRESS_LEVEL is not None:
+            options["method"] = ICON_COMPRESS_LEVEL
+    else:
+        options["quality"] = ICON_QUALITY
+        if image.mode != "RGB":
+            # Jpeg has no transparency so flatten the icon onto white
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, "white")
+            image.paste(rgba, mask=rgba)
+    save_bytes_array = io.BytesIO()
+    image.save(save_bytes_array, format=ICON_FORMAT.pillow_format, **options)
+    return save_bytes_array.getvalue()
+
+
+def resize_icons(image_data: bytes, sizes: tuple[int, ...]) -> dict[int, bytes]:
+    source = Image.open(io.BytesIO(image_data))
+    # Sizes are worked out from the source's full dimensions so cascading
+    # doesn't accumulate rounding errors
+    width, height = source.size
+    # Let jpeg sources decode at a 1/2, 1/4 or 1/8 scale, as thumbnail does,
+    # without going below the gap needed for a good resample
+    draft_size = int(REDUCING_GAP * max(sizes))
+    drafted = source.draft(None, (draft_size, draft_size))
+    # The region of the reduced decode covering the whole source
+    source_box = drafted[1] if drafted else None
+    # Images each size can be resized from, from largest to smallest
+    candidates: list[Image.Image] = [source]
+    icons: dict[int, bytes] = {}
+    for size in sorted(sizes, reverse=True):
+        base = next(
+            candidate
+            for candidate in reversed(candidates)
+            if candidate is source or max(candidate.size) >= CASCADE_MIN_RATIO * size
+        )
+        image = base.resize(
+            fit_size(width, height, size),
+            Image.Resampling.LANCZOS,
+            box=source_box if base is source else None,
+            reducing_gap=REDUCING_GAP,
+        )
+        candidates.append(image)
+        icons[size] = encode_icon(image, size)
+    return icons
+
+
+def process_icon(
+    object_key: str, etag: str = "", resize_pool: Executor | None = None
+) -> None:
+    RATE_LIMITER.acquire()
+    start = time.perf_counter()
+    try:
+        render_icon(object_key, etag, resize_pool)
+    finally:
+        PROCESSING_METRICS.record(time.perf_counter() - start)
+
+
+def render_icon(object_key: str, etag: str, resize_pool: Executor | None) -> None:
+    # Get the new icon from s3, resize it to every size then put the resized
+    # icons back into s3 under different object keys
+    sizes = ICON_SIZES
+    if DEDUP_MODE == ETAG_DEDUP_MODE and etag:
+        if not (sizes := copy_rendered_icons(object_key, etag)):
+            return
+
+    image_data = get_icon(object_key)
+    source_hash = etag
+    if DEDUP_MODE == CONTENT_DEDUP_MODE:
+        source_hash = hashlib.sha256(image_data).hexdigest()
+        if not (sizes := copy_rendered_icons(object_key, source_hash)):
+            return
+
+    if resize_pool is None:
+        icons = resize_icons(image_data, sizes)
+    else:
+        # Runs on an io thread, which only waits while a resize process is busy
+        icons = resize_pool.submit(resize_icons, image_data, sizes).result()
+    put_icons(object_key, icons)
+
+    if DEDUP_MODE != OFF_DEDUP_MODE and source_hash:
+        keep_rendered_icons(object_key, source_hash, list(icons))
 
-    logger.info("Starting to process icons")
+
+def process_message(
+    message: SqsMessage, tracker: MessageTracker, resize_pool: Executor | None = None
+) -> None:
+    try:
+        for s3_object in get_s3_objects(message):
+            process_icon(*s3_object, resize_pool=resize_pool)
+    except Exception:
+        logger.exception(f"Failed to process message {message['MessageId']}")
+        # Stop extending it so it is redelivered once its visibility timeout
+        # passes
+        tracker.release([message])
+        return
+    tracker.ack(message)
+
+
+def process_messages_pipelined(
+    messages: list[SqsMessage],
+    tracker: MessageTracker,
+    io_pool: Executor,
+    resize_pool: Executor,
+) -> None:
+    owners: dict[Future, SqsMessage] = {}
+    remaining: dict[str, int] = {}
+    for message in messages:
+        s3_objects = get_s3_objects(message)
+        remaining[message["MessageId"]] = len(s3_objects)
+        if not s3_objects:
+            tracker.ack(message)
+        for s3_object in s3_objects:
+            future = io_pool.submit(process_icon, *s3_object, resize_pool)
+            owners[future] = message
+
+    # Acknowledge each message as soon as all of its icons are done
+    failed: set[str] = set()
+    for future in as_completed(owners):
+        message = owners[future]
+        message_id = message["MessageId"]
+        if exception := future.exception():
+            logger.error(f"Failed to process message {message_id}: {exception!r}")
+            failed.add(message_id)
+        remaining[message_id] -= 1
+        if not remaining[message_id] and message_id not in failed:
+            tracker.ack(message)
+
+
+def create_pools() -> tuple[ThreadPoolExecutor, ProcessPoolExecutor]:
+    # Spawn the resize processes rather than forking them from a process that
+    # is already running io threads
+    return ThreadPoolExecutor(IO_WORKERS), ProcessPoolExecutor(
+        RESIZE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def consume(
+    prefetcher: MessagePrefetcher, process: Callable[[SqsMessage], None]
+) -> None:
+    while True:
+        message = prefetcher.get()
+        logger.info(f"Processing message {message['MessageId']}")
+        process(message)
+
+
+def run_prefetching(tracker: MessageTracker) -> None:
+    prefetcher = MessagePrefetcher(tracker, PREFETCH_BUFFER_SIZE)
+
+    if WORKER_MODE != PIPELINED_WORKER_MODE:
+        consume(prefetcher, lambda message: process_message(message, tracker))
+        return
+
+    # Each io thread consumes messages straight from the buffer, so a new
+    # message starts as soon as any thread frees up
+    io_pool, resize_pool = create_pools()
+    logger.info(
+        f"Using {IO_WORKERS} io threads and {RESIZE_WORKERS} resize processes"
+    )
+    consumers = [
+        io_pool.submit(
+            consume,
+            prefetcher,
+            lambda message: process_message(message, tracker, resize_pool),
+        )
+        for _ in range(IO_WORKERS)
+    ]
+    # The consumers only return if they crash
+    for consumer in as_completed(consumers):
+        consumer.result()
+
+
+def run_polling(tracker: MessageTracker) -> None:
+    if WORKER_MODE == PIPELINED_WORKER_MODE:
+        io_pool, resize_pool = create_pools()
+        logger.info(
+            f"Using {IO_WORKERS} io threads and {RESIZE_WORKERS} resize processes"
+        )
 
     # Poll the sqs queue indefinitely
     while True:
 
-        with next_icon_paths() as object_keys:
+        with next_icon_messages(tracker) as messages:
             logger.info("Got the following icons to process")
-            logger.info(json.dumps(object_keys))
-
-            for object_key in object_keys:
-                # Get the new icon from s3, resize then put the resized icon
-                # back into s3 under a different object key
-                s3_response: dict = S3_CLIENT.get_object(
-                    Bucket=ICONS_BUCKET_NAME, Key=object_key
-                )
-                image_data: bytes = s3_response["Body"].read()
-                image = Image.open(io.BytesIO(image_data))
-                image.thumbnail((ICON_SIZE, ICON_SIZE), Image.Resampling.LANCZOS)
-                save_bytes_array = io.BytesIO()
-                image.save(save_bytes_array, format="png")
-                S3_CLIENT.put_object(
-                    Body=save_bytes_array.getvalue(),
-                    Bucket=ICONS_BUCKET_NAME,
-                    Key=get_resized_object_key(object_key, ICON_SIZE),
-                )
+            logger.info(
+                json.dumps([get_object_keys(message) for message in messages])
+            )
 
-                # Artificially inflate the time it takes to process an image
-                time.sleep(5)
+            if WORKER_MODE == PIPELINED_WORKER_MODE:
+                process_messages_pipelined(messages, tracker, io_pool, resize_pool)
+            else:
+                for message in messages:
+                    process_message(message, tracker)
 
         logger.info("Finished processing icons")
 
@@ -132,4 +850,26 @@ def main() -> None:
             time.sleep(sleep_time_seconds)
 
 
-main()
+def main() -> None:
+    if not SQS_URL:
+        logger.error("No sqs url set in environment")
+
+    if not ICONS_BUCKET_NAME:
+        logger.error("No bucket arn set in environment")
+
+    if not ICON_SIZES:
+        logger.error("No icon size set in environment")
+
+    logger.info("Starting to process icons")
+    tracker = MessageTracker()
+    if METRIC_INTERVAL > 0:
+        PROCESSING_METRICS.start(METRIC_INTERVAL)
+
+    if CONSUMER_MODE == PREFETCH_CONSUMER_MODE:
+        run_prefetching(tracker)
+    else:
+        run_polling(tracker)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,17 +7,64 @@ import os
 import json
 import logging
 import math
+import statistics
 import time
-from typing import cast, Any, Final, TypedDict
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import cast, Any, Final, NamedTuple, TypedDict
 
 import boto3
 
 
 RESOURCES_STRING: Final[str] = os.environ.get("RESOURCES_STRING") or ""
 
+# "serial" queries and publishes each resource in turn. "batched" queries every
+# resource concurrently, counts tasks with one describe_services call per 10
+# services and publishes every size with a single put_metric_data call.
+SERIAL_COLLECTION_MODE = "serial"
+BATCHED_COLLECTION_MODE = "batched"
+COLLECTION_MODE: Final[str] = (
+    os.environ.get("COLLECTION_MODE") or SERIAL_COLLECTION_MODE
+).lower()
+# The most services describe_services accepts in one call
+ECS_MAX_DESCRIBE_SERVICES = 10
+# The most metrics put_metric_data accepts in one call
+CLOUDWATCH_MAX_METRIC_DATA = 1000
+
+# "instantaneous" derives the metric from the current queue length and task
+# count alone. "predictive" keeps a sliding window of samples, estimates the
+# rate messages arrive at and are processed at, and reports the number of
+# tasks needed to keep up with arrivals while draining the forecast backlog
+# within DRAIN_SECONDS, as a percentage of the running tasks.
+INSTANTANEOUS_METRIC_MODE = "instantaneous"
+PREDICTIVE_METRIC_MODE = "predictive"
+METRIC_MODE: Final[str] = (
+    os.environ.get("METRIC_MODE") or INSTANTANEOUS_METRIC_MODE
+).lower()
+# The expected number of messages a single task processes per second. Raised
+# while the queue is seen draining faster than this in at least
+# MIN_DRAIN_RATES of the samples, so a single noisy sample can't raise it.
+TASK_SERVICE_RATE: Final[float] = float(os.environ.get("TASK_SERVICE_RATE") or 1)
+MIN_DRAIN_RATES: Final[int] = 3
+SAMPLE_WINDOW_SECONDS: Final[float] = float(
+    os.environ.get("SAMPLE_WINDOW_SECONDS") or 120
+)
+# How far ahead to forecast the backlog, roughly the time a new task takes to
+# start processing
+FORECAST_SECONDS: Final[float] = float(os.environ.get("FORECAST_SECONDS") or 60)
+DRAIN_SECONDS: Final[float] = float(os.environ.get("DRAIN_SECONDS") or 120)
+PREDICTIVE_MAX_METRIC_VALUE: Final[float] = 1000
+# An optional dynamodb table, with an "IconSize" string partition key, used to
+# keep the sample windows between cold starts
+STATE_TABLE_NAME: Final[str] = os.environ.get("STATE_TABLE_NAME") or ""
+
+ITERATIONS: Final[int] = 6
+SECONDS_IN_MINUTE: Final[int] = 60
+
 CLOUDWATCH_CLIENT: Final = boto3.client("cloudwatch")
 ECS_CLIENT: Final = boto3.client("ecs")
 SQS_CLIENT: Final = boto3.client("sqs")
+DYNAMODB_CLIENT: Final = boto3.client("dynamodb")
 
 logger: logging.Logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -30,6 +77,22 @@ class ResourceInfo(TypedDict):
     ServiceName: str
 
 
+class QueueDepth(NamedTuple):
+    visible: int
+    in_flight: int
+
+
+class Sample(NamedTuple):
+    timestamp: float
+    visible: int
+    in_flight: int
+    tasks: int
+
+
+# The recent samples of each icon size, kept between warm invocations
+SAMPLE_WINDOWS: Final[dict[str, list[Sample]]] = {}
+
+
 def get_metric_value(
     ecs_task_count: int, approximate_number_of_messages_visible: int, /
 ) -> int:
@@ -55,73 +118,263 @@ def get_metric_value(
     )
 
 
-def handler(event: Any, context: Any):
-    if not RESOURCES_STRING:
-        logger.error("No RESOURCE_STRING set in environment")
+def net_arrival_rate(samples: list[Sample]) -> float:
+    # The least squares slope of the messages in the queue over time, which is
+    # how much faster messages arrive than they are processed
+    times = [sample.timestamp for sample in samples]
+    totals = [sample.visible + sample.in_flight for sample in samples]
+    mean_time = sum(times) / len(times)
+    mean_total = sum(totals) / len(totals)
+    variance = sum((timestamp - mean_time) ** 2 for timestamp in times)
+    if not variance:
+        return 0.0
+    covariance = sum(
+        (timestamp - mean_time) * (total - mean_total)
+        for timestamp, total in zip(times, totals)
+    )
+    return covariance / variance
 
-    resources: list[ResourceInfo] = cast(
-        list[ResourceInfo], json.loads(RESOURCES_STRING)
+
+def estimate_service_rate(samples: list[Sample]) -> float:
+    # While a backlog drains, each task processes at least as many messages as
+    # the queue shrinks by, whatever the arrival rate. Single 10 second drain
+    # rates are noisy, so only their median can raise the estimate, and only
+    # once there are a few of them.
+    drain_rates = [
+        (
+            (previous.visible + previous.in_flight)
+            - (sample.visible + sample.in_flight)
+        )
+        / (sample.timestamp - previous.timestamp)
+        / previous.tasks
+        for previous, sample in zip(samples, samples[1:])
+        if previous.visible and sample.visible and previous.tasks
+        if sample.timestamp > previous.timestamp
+    ]
+    if len(drain_rates) < MIN_DRAIN_RATES:
+        return TASK_SERVICE_RATE
+    return max(statistics.median(drain_rates), TASK_SERVICE_RATE)
+
+
+def get_predictive_metric_value(samples: list[Sample]) -> float:
+    latest = samples[-1]
+    service_rate = estimate_service_rate(samples)
+    net_rate = net_arrival_rate(samples)
+    if latest.visible:
+        # With a backlog every task is busy, so they process at their full rate
+        arrival_rate = net_rate + service_rate * latest.tasks
+    else:
+        # Otherwise by Little's law, the messages in flight are the arrival
+        # rate times the time taken to process each message
+        arrival_rate = max(net_rate, 0) + service_rate * latest.in_flight
+    forecast_backlog = latest.visible + net_rate * FORECAST_SECONDS
+    needed_tasks = (
+        max(arrival_rate, 0) + max(forecast_backlog, 0) / DRAIN_SECONDS
+    ) / service_rate
+    return min(
+        100 * needed_tasks / max(latest.tasks, 1), PREDICTIVE_MAX_METRIC_VALUE
     )
 
-    logger.info("Using the following resources: " + json.dumps(resources))
 
-    iterations: int = 6
+def record_sample(icon_size: str, sample: Sample) -> list[Sample]:
+    window = [
+        previous
+        for previous in SAMPLE_WINDOWS.get(icon_size, [])
+        if sample.timestamp - previous.timestamp <= SAMPLE_WINDOW_SECONDS
+    ]
+    window.append(sample)
+    SAMPLE_WINDOWS[icon_size] = window
+    return window
 
-    for _ in range(iterations):
-        for resource_info in resources:
-            sqs_url = resource_info["SqsUrl"]
-            service_name = resource_info["ServiceName"]
-            cluster = resource_info["Cluster"]
 
-            list_tasks_response = ECS_CLIENT.list_tasks(
-                serviceName=service_name, cluster=cluster
-            )
-            get_queue_attributes_response = SQS_CLIENT.get_queue_attributes(
-                QueueUrl=sqs_url, AttributeNames=["ApproximateNumberOfMessages"]
-            )
+def load_sample_windows(resources: list[ResourceInfo]) -> None:
+    for resource_info in resources:
+        icon_size = f'size{resource_info["Size"]}'
+        if icon_size in SAMPLE_WINDOWS:
+            continue
+        item = DYNAMODB_CLIENT.get_item(
+            TableName=STATE_TABLE_NAME,
+            Key={"IconSize": {"S": icon_size}},
+            ConsistentRead=True,
+        ).get("Item")
+        if item:
+            SAMPLE_WINDOWS[icon_size] = [
+                Sample(*sample) for sample in json.loads(item["Samples"]["S"])
+            ]
 
-            if list_tasks_response.get("nextToken"):
-                logger.error(
-                    "The number of tasks has exceeded the maximum number of tasks in the list_task response."
-                )
 
-            ecs_task_count = len(list_tasks_response["taskArns"])
-            approximate_number_of_messages_visible = int(
-                get_queue_attributes_response["Attributes"][
-                    "ApproximateNumberOfMessages"
-                ]
-            )
-            metric_value = get_metric_value(
-                ecs_task_count, approximate_number_of_messages_visible
-            )
+def save_sample_windows() -> None:
+    for icon_size, window in SAMPLE_WINDOWS.items():
+        DYNAMODB_CLIENT.put_item(
+            TableName=STATE_TABLE_NAME,
+            Item={
+                "IconSize": {"S": icon_size},
+                "Samples": {"S": json.dumps(window)},
+            },
+        )
 
-            logger.info(
-                json.dumps(
-                    {
-                        "ecs_task_count": ecs_task_count,
-                        "approximate_number_of_messages_visible ": approximate_number_of_messages_visible,
-                        "metric_value": metric_value,
-                    }
-                ),
-            )
 
-            # Publish the metric, see: https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/publishingMetrics.html
-            put_metric_data_response = CLOUDWATCH_CLIENT.put_metric_data(
-                Namespace="Service/ImageResize",
-                MetricData=[
-                    {
-                        "MetricName": "EcsTargetMetric",
-                        "Dimensions": [
-                            {
-                                "Name": "IconSize",
-                                "Value": f'size{resource_info["Size"]}',
-                            }
-                        ],
-                        "Value": metric_value,
-                        "StorageResolution": 1,
-                    }
-                ],
+def compute_metric_value(
+    resource_info: ResourceInfo, ecs_task_count: int, queue_depth: QueueDepth
+) -> float:
+    if METRIC_MODE == PREDICTIVE_METRIC_MODE:
+        window = record_sample(
+            f'size{resource_info["Size"]}',
+            Sample(time.time(), *queue_depth, ecs_task_count),
+        )
+        metric_value = get_predictive_metric_value(window)
+    else:
+        metric_value = get_metric_value(ecs_task_count, queue_depth.visible)
+    log_metric_value(ecs_task_count, queue_depth.visible, metric_value)
+    return metric_value
+
+
+def count_tasks(cluster: str, service_name: str) -> int:
+    # Page through every task, a single list_tasks response holds at most 100
+    paginator = ECS_CLIENT.get_paginator("list_tasks")
+    return sum(
+        len(page["taskArns"])
+        for page in paginator.paginate(serviceName=service_name, cluster=cluster)
+    )
+
+
+def count_service_tasks(
+    resources: list[ResourceInfo], executor: ThreadPoolExecutor
+) -> dict[tuple[str, str], int]:
+    services_by_cluster: dict[str, list[str]] = defaultdict(list)
+    for resource_info in resources:
+        services_by_cluster[resource_info["Cluster"]].append(
+            resource_info["ServiceName"]
+        )
+    requests = [
+        (cluster, service_names[index : index + ECS_MAX_DESCRIBE_SERVICES])
+        for cluster, service_names in services_by_cluster.items()
+        for index in range(0, len(service_names), ECS_MAX_DESCRIBE_SERVICES)
+    ]
+    responses = executor.map(
+        lambda request: ECS_CLIENT.describe_services(
+            cluster=request[0], services=request[1]
+        ),
+        requests,
+    )
+
+    task_counts: dict[tuple[str, str], int] = {}
+    for (cluster, _), response in zip(requests, responses):
+        for failure in response.get("failures", []):
+            logger.error(f"Could not describe service: {json.dumps(failure)}")
+        for service in response["services"]:
+            # list_tasks counts pending tasks as well as running ones
+            task_counts[cluster, service["serviceName"]] = (
+                service["runningCount"] + service["pendingCount"]
             )
+    return task_counts
+
+
+def get_queue_depth(sqs_url: str) -> QueueDepth:
+    get_queue_attributes_response = SQS_CLIENT.get_queue_attributes(
+        QueueUrl=sqs_url,
+        AttributeNames=[
+            "ApproximateNumberOfMessages",
+            "ApproximateNumberOfMessagesNotVisible",
+        ],
+    )
+    attributes = get_queue_attributes_response["Attributes"]
+    return QueueDepth(
+        int(attributes["ApproximateNumberOfMessages"]),
+        int(attributes["ApproximateNumberOfMessagesNotVisible"]),
+    )
+
+
+def put_metric_values(metric_values: list[tuple[ResourceInfo, float]]) -> None:
+    metric_data = [
+        {
+            "MetricName": "EcsTargetMetric",
+            "Dimensions": [
+                {
+                    "Name": "IconSize",
+                    "Value": f'size{resource_info["Size"]}',
+                }
+            ],
+            "Value": metric_value,
+            "StorageResolution": 1,
+        }
+        for resource_info, metric_value in metric_values
+    ]
+    # Publish the metric, see: https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/publishingMetrics.html
+    for index in range(0, len(metric_data), CLOUDWATCH_MAX_METRIC_DATA):
+        CLOUDWATCH_CLIENT.put_metric_data(
+            Namespace="Service/ImageResize",
+            MetricData=metric_data[index : index + CLOUDWATCH_MAX_METRIC_DATA],
+        )
+
+
+def log_metric_value(
+    ecs_task_count: int, approximate_number_of_messages_visible: int, metric_value
+) -> None:
+    logger.info(
+        json.dumps(
+            {
+                "ecs_task_count": ecs_task_count,
+                "approximate_number_of_messages_visible ": approximate_number_of_messages_visible,
+                "metric_value": metric_value,
+            }
+        ),
+    )
+
+
+def collect_serial(resources: list[ResourceInfo]) -> None:
+    for resource_info in resources:
+        ecs_task_count = count_tasks(
+            resource_info["Cluster"], resource_info["ServiceName"]
+        )
+        queue_depth = get_queue_depth(resource_info["SqsUrl"])
+        metric_value = compute_metric_value(resource_info, ecs_task_count, queue_depth)
+        put_metric_values([(resource_info, metric_value)])
+
+
+def collect_batched(
+    resources: list[ResourceInfo], executor: ThreadPoolExecutor
+) -> None:
+    queue_depths = executor.map(
+        get_queue_depth, [resource_info["SqsUrl"] for resource_info in resources]
+    )
+    task_counts = count_service_tasks(resources, executor)
+
+    metric_values: list[tuple[ResourceInfo, float]] = []
+    for resource_info, queue_depth in zip(resources, queue_depths):
+        ecs_task_count = task_counts.get(
+            (resource_info["Cluster"], resource_info["ServiceName"]), 0
+        )
+        metric_value = compute_metric_value(resource_info, ecs_task_count, queue_depth)
+        metric_values.append((resource_info, metric_value))
+    put_metric_values(metric_values)
+
+
+def handler(event: Any, context: Any):
+    if not RESOURCES_STRING:
+        logger.error("No RESOURCE_STRING set in environment")
+
+    resources: list[ResourceInfo] = cast(
+        list[ResourceInfo], json.loads(RESOURCES_STRING)
+    )
+
+    logger.info("Using the following resources: " + json.dumps(resources))
+
+    keep_state = METRIC_MODE == PREDICTIVE_METRIC_MODE and STATE_TABLE_NAME
+    if keep_state:
+        load_sample_windows(resources)
+
+    tick_seconds = SECONDS_IN_MINUTE / ITERATIONS
+    with ThreadPoolExecutor(max(len(resources), 1)) as executor:
+        for _ in range(ITERATIONS):
+            tick_start = time.monotonic()
+            if COLLECTION_MODE == BATCHED_COLLECTION_MODE:
+                collect_batched(resources, executor)
+                # Keep the ticks evenly spaced however long collecting took
+                time.sleep(max(tick_seconds - (time.monotonic() - tick_start), 0))
+            else:
+                collect_serial(resources)
+                time.sleep(tick_seconds)
 
-        seconds_in_minute: int = 60
-        time.sleep(seconds_in_minute / iterations)
+    if keep_state:
+        save_sample_windows()
@@ -4,13 +4,87 @@ __author__ = "Michael Ciccotosto-Camp"
 __version__ = ""
 
 import os
+import heapq
+import itertools
 import json
 import logging
-from typing import TypeVar, Iterable, TypedDict, Any
+import math
+import statistics
+import tempfile
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    cast,
+    TypeVar,
+    Iterable,
+    Iterator,
+    TypedDict,
+    Any,
+    Final,
+    NotRequired,
+)
+
+import boto3
 
 DEFAULT_MAX_CONCURRENCY = 5
 MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY") or DEFAULT_MAX_CONCURRENCY)
 
+# "fixed" splits the resources into consecutive chunks of MAX_CONCURRENCY.
+# "balanced" bin-packs the resources into the same number of batches so each
+# batch has roughly the same estimated number of bytes to download.
+# "host" does the same but keeps every batch to a single host so each download
+# lambda can reuse its connections.
+FIXED_PARTITION_STRATEGY = "fixed"
+BALANCED_PARTITION_STRATEGY = "balanced"
+HOST_PARTITION_STRATEGY = "host"
+PARTITION_STRATEGY: Final[str] = (
+    os.getenv("PARTITION_STRATEGY") or FIXED_PARTITION_STRATEGY
+).lower()
+
+# Send a HEAD request for any resource without a size hint to find its size
+SIZE_HINT_HEAD_REQUESTS: Final[bool] = (
+    os.getenv("SIZE_HINT_HEAD_REQUESTS") or ""
+).lower() == "true"
+# Size assumed for resources without a hint when no hints are known at all
+DEFAULT_RESOURCE_SIZE: Final[int] = int(
+    os.getenv("DEFAULT_RESOURCE_SIZE") or 64 * 1024
+)
+# Caps how many resources the balanced strategies may place into one batch, so
+# a poor size estimate can't leave a single download lambda with most of the
+# work
+MAX_BATCH_RESOURCES: Final[int] = max(
+    int(os.getenv("MAX_BATCH_RESOURCES") or 4 * MAX_CONCURRENCY), MAX_CONCURRENCY
+)
+# Accounts for the fixed latency of each request, expressed as the number of
+# bytes that could have been downloaded in that time, so that batches of many
+# tiny resources aren't treated as free
+REQUEST_OVERHEAD_BYTES: Final[int] = int(
+    os.getenv("REQUEST_OVERHEAD_BYTES") or 512 * 1024
+)
+
+# Large manifests can be given as a newline delimited s3 object of resource
+# paths instead of inline. The manifest is streamed, partitioned
+# MANIFEST_WINDOW_SIZE paths at a time with the PARTITION_STRATEGY, and the
+# batches are written to a single json index object, which a distributed Map
+# state reads with its ItemReader, so only a pointer to it is passed on.
+S3_CLIENT: Final[Any] = boto3.client("s3")
+DEFAULT_MANIFEST_WINDOW_SIZE = 10000
+MANIFEST_WINDOW_SIZE: Final[int] = max(
+    int(os.getenv("MANIFEST_WINDOW_SIZE") or DEFAULT_MANIFEST_WINDOW_SIZE),
+    MAX_CONCURRENCY,
+)
+# Defaults to the bucket holding the input manifest
+BATCH_MANIFEST_BUCKET_NAME: Final[str] = os.getenv("BATCH_MANIFEST_BUCKET_NAME") or ""
+BATCH_MANIFEST_PREFIX: Final[str] = os.getenv("BATCH_MANIFEST_PREFIX") or "batches"
+
+
+class S3Pointer(TypedDict):
+    bucket: str
+    key: str
+
 
 class BatchPayload(TypedDict):
     baseUrl: str
@@ -18,7 +92,11 @@ class BatchPayload(TypedDict):
 
 
 class InputPayload(BatchPayload):
-    resourcePaths: list[str]
+    # Either resourcePaths or manifest must be given
+    resourcePaths: NotRequired[list[str]]
+    manifest: NotRequired[S3Pointer]
+    # Optional estimate of the size in bytes of each resource path
+    resourceSizes: NotRequired[dict[str, int]]
 
 
 class BatchResources(TypedDict):
@@ -27,7 +105,11 @@ class BatchResources(TypedDict):
 
 
 class OutputPayload(TypedDict):
-    tasks: list[BatchResources]
+    # Either the batches themselves or, for a manifest, a pointer to a json
+    # array of them
+    tasks: NotRequired[list[BatchResources]]
+    taskIndex: NotRequired[S3Pointer]
+    taskCount: NotRequired[int]
 
 
 T = TypeVar("T")
@@ -38,23 +120,231 @@ def partition(iterable: Iterable[T], size: int) -> list[list[T]]:
     return [lst[index : index + size] for index in range(0, len(lst), size)]
 
 
-def handler(payload: InputPayload, _: Any) -> OutputPayload:
+def batch_duration(costs: Iterable[float], concur_req: int) -> float:
+    # A download lambda works through its batch concurrency requests at a time
+    # so it takes at least as long as its most expensive resource
+    costs = list(costs)
+    return max(max(costs, default=0.0), sum(costs) / max(concur_req, 1))
+
+
+def ipartition(iterable: Iterable[T], size: int) -> Iterator[list[T]]:
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def partition_balanced(
+    items: list[T], costs: list[float], batch_count: int, concur_req: int
+) -> list[list[T]]:
+    concur_req = max(concur_req, 1)
+    batch_count = max(batch_count, math.ceil(len(items) / MAX_BATCH_RESOURCES), 1)
+    batches: list[list[T]] = [[] for _ in range(batch_count)]
+    batch_costs: list[list[float]] = [[] for _ in batches]
+    # Both heaps are updated lazily, entries with an outdated version are
+    # skipped when they reach the top
+    versions = [0] * len(batches)
+    by_duration = [(0.0, index, 0) for index in range(len(batches))]
+    by_slack: list[tuple[float, int, int]] = []
+
+    def top(heap: list[tuple[float, int, int]]) -> tuple[float, int, int] | None:
+        while heap and heap[0][2] != versions[heap[0][1]]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    # Place the most expensive resources first. Each resource goes into a batch
+    # with enough idle download slots to absorb it without finishing any later,
+    # otherwise into the batch that is estimated to finish first.
+    for index in sorted(range(len(items)), key=costs.__getitem__, reverse=True):
+        cost = costs[index]
+        most_slack = top(by_slack)
+        if most_slack is not None and -most_slack[0] >= cost:
+            batch_index = most_slack[1]
+        else:
+            batch_index = cast(tuple[float, int, int], top(by_duration))[1]
+        batches[batch_index].append(items[index])
+        batch_costs[batch_index].append(cost)
+        versions[batch_index] += 1
+        if len(batches[batch_index]) >= MAX_BATCH_RESOURCES:
+            # Leave its outdated heap entries behind so it is never picked again
+            continue
+        duration = batch_duration(batch_costs[batch_index], concur_req)
+        slack = duration * concur_req - sum(batch_costs[batch_index])
+        heapq.heappush(by_duration, (duration, batch_index, versions[batch_index]))
+        heapq.heappush(by_slack, (-slack, batch_index, versions[batch_index]))
+
+    # The Map state starts batches in order, so starting the longest batches
+    # first stops them from straggling at the end of the run
+    ordered = sorted(
+        zip(batches, batch_costs),
+        key=lambda pair: batch_duration(pair[1], concur_req),
+        reverse=True,
+    )
+    return [batch for batch, _ in ordered if batch]
+
+
+def resource_url(base_url: str, resource_path: str) -> str:
+    # Resource paths may also be absolute urls on other hosts
+    if urllib.parse.urlparse(resource_path).scheme:
+        return resource_path
+    return f"{base_url}/{resource_path}"
+
+
+def partition_by_host(
+    resource_paths: list[str],
+    costs: list[float],
+    batch_count: int,
+    concur_req: int,
+    base_url: str,
+) -> list[list[str]]:
+    host_indices: dict[str, list[int]] = defaultdict(list)
+    for index, resource_path in enumerate(resource_paths):
+        host = urllib.parse.urlparse(resource_url(base_url, resource_path)).netloc
+        host_indices[host].append(index)
+
+    total_cost = sum(costs) or 1.0
+    batches: list[list[str]] = []
+    for indices in host_indices.values():
+        # Give each host a share of the batches in proportion to its work
+        host_cost = sum(costs[index] for index in indices)
+        host_batch_count = min(
+            max(round(batch_count * host_cost / total_cost), 1), len(indices)
+        )
+        batches.extend(
+            partition_balanced(
+                [resource_paths[index] for index in indices],
+                [costs[index] for index in indices],
+                host_batch_count,
+                concur_req,
+            )
+        )
+    path_costs = dict(zip(resource_paths, costs))
+    return sorted(
+        batches,
+        key=lambda batch: batch_duration(
+            map(path_costs.__getitem__, batch), concur_req
+        ),
+        reverse=True,
+    )
+
+
+def head_content_length(url: str) -> int | None:
+    request = urllib.request.Request(url, method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            content_length = response.headers.get("Content-Length")
+    except OSError:
+        return None
+    return int(content_length) if content_length else None
+
+
+def head_sizes(
+    base_url: str, resource_paths: list[str], concur_req: int
+) -> dict[str, int]:
+    with ThreadPoolExecutor(max_workers=max(concur_req, 1)) as executor:
+        content_lengths = executor.map(
+            head_content_length,
+            (resource_url(base_url, path) for path in resource_paths),
+        )
+        return {
+            path: content_length
+            for path, content_length in zip(resource_paths, content_lengths)
+            if content_length is not None
+        }
+
+
+def estimate_costs(
+    resource_paths: list[str], size_hints: dict[str, int]
+) -> list[float]:
+    known_sizes = [size_hints[path] for path in resource_paths if path in size_hints]
+    fallback_size = (
+        statistics.median(known_sizes) if known_sizes else DEFAULT_RESOURCE_SIZE
+    )
+    return [
+        float(size_hints.get(path, fallback_size) + REQUEST_OVERHEAD_BYTES)
+        for path in resource_paths
+    ]
+
+
+def partition_resources(payload: InputPayload, strategy: str) -> list[list[str]]:
+    resource_paths = payload.get("resourcePaths") or []
+    if strategy == FIXED_PARTITION_STRATEGY:
+        return partition(resource_paths, MAX_CONCURRENCY)
+
+    concur_req = int(payload["lambdaConcur"] or 1)
+    size_hints = dict(payload.get("resourceSizes") or {})
+    if SIZE_HINT_HEAD_REQUESTS:
+        missing = [path for path in resource_paths if path not in size_hints]
+        size_hints |= head_sizes(payload["baseUrl"], missing, concur_req)
+    costs = estimate_costs(resource_paths, size_hints)
+    # Keep the same number of batches as the fixed split
+    batch_count = math.ceil(len(resource_paths) / MAX_CONCURRENCY)
+
+    if strategy == HOST_PARTITION_STRATEGY:
+        return partition_by_host(
+            resource_paths, costs, batch_count, concur_req, payload["baseUrl"]
+        )
+    return partition_balanced(resource_paths, costs, batch_count, concur_req)
+
+
+def read_manifest(manifest: S3Pointer) -> Iterator[str]:
+    s3_response = S3_CLIENT.get_object(Bucket=manifest["bucket"], Key=manifest["key"])
+    for line in s3_response["Body"].iter_lines():
+        if resource_path := line.decode("utf-8").strip():
+            yield resource_path
+
+
+def batch_resources(payload: InputPayload) -> Iterator[BatchResources]:
+    batch_input: BatchPayload = {
+        "baseUrl": payload["baseUrl"],
+        "lambdaConcur": payload["lambdaConcur"],
+    }
+    if manifest := payload.get("manifest"):
+        # Only a window of the manifest is held in memory at once
+        for window in ipartition(read_manifest(manifest), MANIFEST_WINDOW_SIZE):
+            window_payload: InputPayload = {**payload, "resourcePaths": window}
+            for resource_partition in partition_resources(
+                window_payload, PARTITION_STRATEGY
+            ):
+                yield {"resourcePaths": resource_partition, "batchInput": batch_input}
+        return
+
+    for resource_partition in partition_resources(payload, PARTITION_STRATEGY):
+        yield {"resourcePaths": resource_partition, "batchInput": batch_input}
+
+
+def write_task_index(
+    tasks: Iterable[BatchResources], bucket: str, key: str
+) -> OutputPayload:
+    task_count = 0
+    # Spool the json array to disk, then let s3 upload it in parts
+    with tempfile.TemporaryFile() as task_index:
+        task_index.write(b"[")
+        for task in tasks:
+            if task_count:
+                task_index.write(b",\n")
+            task_index.write(json.dumps(task).encode("utf-8"))
+            task_count += 1
+        task_index.write(b"]")
+        task_index.seek(0)
+        S3_CLIENT.upload_fileobj(task_index, bucket, key)
+    return {"taskIndex": {"bucket": bucket, "key": key}, "taskCount": task_count}
+
+
+def handler(payload: InputPayload, context: Any) -> OutputPayload:
     logger: logging.Logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
     logger.info("Payload:")
     logger.info(json.dumps(payload))
 
-    return {
-        "tasks": [
-            {
-                "resourcePaths": resource_partition,
-                "batchInput": {
-                    "baseUrl": payload["baseUrl"],
-                    "lambdaConcur": payload["lambdaConcur"],
-                },
-            }
-            for resource_partition in partition(
-                payload["resourcePaths"], MAX_CONCURRENCY
-            )
-        ]
-    }
+    if manifest := payload.get("manifest"):
+        # Keep the indexes of different runs apart
+        run_id = getattr(context, "aws_request_id", None) or str(uuid.uuid4())
+        output = write_task_index(
+            batch_resources(payload),
+            BATCH_MANIFEST_BUCKET_NAME or manifest["bucket"],
+            f"{BATCH_MANIFEST_PREFIX}/{run_id}.json",
+        )
+        logger.info(json.dumps(output))
+        return output
+
+    return {"tasks": list(batch_resources(payload))}
@@ -3,15 +3,145 @@
 __author__ = "Michael Ciccotosto-Camp"
 __version__ = ""
 
+import os
 import logging
 import json
+import math
+import time
+from collections import Counter
 from http import HTTPStatus
-from typing import Any
+from typing import Any, Final, NotRequired, TypedDict
 
+# Print the summary as a CloudWatch embedded metric format blob so the
+# statistics can be graphed without any extra api calls
+EMIT_EMF_METRICS: Final[bool] = (
+    os.getenv("EMIT_EMF_METRICS") or ""
+).lower() == "true"
+METRICS_NAMESPACE: Final[str] = os.getenv("METRICS_NAMESPACE") or "StepFunctionMapIo"
 
-def handler(payload: list[int], _: Any) -> bool:
+
+class CompletedTask(TypedDict):
+    url: str
+    statusCode: int
+    filename: NotRequired[str]
+    message: NotRequired[str]
+    notModified: NotRequired[bool]
+    contentLength: NotRequired[int]
+    elapsed: NotRequired[float]
+    attempts: NotRequired[int]
+
+
+class LatencySummary(TypedDict):
+    p50: float
+    p90: float
+    p99: float
+    max: float
+
+
+class BatchSummary(TypedDict):
+    tasks: int
+    statusCounts: dict[str, int]
+    notModified: int
+    retries: int
+    bytes: int
+    latency: LatencySummary
+
+
+class Summary(BatchSummary):
+    allSucceeded: bool
+    batches: list[BatchSummary]
+
+
+def percentile(ordered: list[float], percent: float) -> float:
+    # Nearest rank percentile of an already sorted list
+    if not ordered:
+        return 0.0
+    rank = max(math.ceil(len(ordered) * percent / 100), 1)
+    return ordered[rank - 1]
+
+
+def summarise_batch(tasks: list[CompletedTask]) -> BatchSummary:
+    latencies = sorted(float(task.get("elapsed", 0.0)) for task in tasks)
+    return {
+        "tasks": len(tasks),
+        "statusCounts": dict(
+            sorted(Counter(str(task["statusCode"]) for task in tasks).items())
+        ),
+        "notModified": sum(bool(task.get("notModified")) for task in tasks),
+        "retries": sum(max(int(task.get("attempts", 1)) - 1, 0) for task in tasks),
+        "bytes": sum(int(task.get("contentLength", 0)) for task in tasks),
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else 0.0,
+        },
+    }
+
+
+def summarise(batches: list[list[CompletedTask]]) -> Summary:
+    all_tasks = [task for batch in batches for task in batch]
+    return {
+        **summarise_batch(all_tasks),
+        "allSucceeded": all(
+            int(task["statusCode"]) == int(HTTPStatus.OK) for task in all_tasks
+        ),
+        "batches": [summarise_batch(batch) for batch in batches],
+    }
+
+
+def emf_metrics(summary: Summary) -> dict[str, Any]:
+    failed = sum(
+        count
+        for status_code, count in summary["statusCounts"].items()
+        if int(status_code) != int(HTTPStatus.OK)
+    )
+    metrics = {
+        "Tasks": (summary["tasks"], "Count"),
+        "FailedTasks": (failed, "Count"),
+        "NotModifiedTasks": (summary["notModified"], "Count"),
+        "Retries": (summary["retries"], "Count"),
+        "BytesTransferred": (summary["bytes"], "Bytes"),
+        "LatencyP50": (summary["latency"]["p50"], "Seconds"),
+        "LatencyP99": (summary["latency"]["p99"], "Seconds"),
+    }
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [[]],
+                    "Metrics": [
+                        {"Name": name, "Unit": unit}
+                        for name, (_, unit) in metrics.items()
+                    ],
+                }
+            ],
+        },
+        **{name: value for name, (value, _) in metrics.items()},
+    }
+
+
+def handler(
+    payload: list[int] | list[CompletedTask] | list[list[CompletedTask]], _: Any
+) -> bool | Summary:
     logger: logging.Logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
     logger.info("Payload:")
     logger.info(json.dumps(payload))
-    return all(int(task_status) == int(HTTPStatus.OK) for task_status in payload)
+
+    if not payload or not isinstance(payload[0], (dict, list)):
+        # Just the status codes were given
+        return all(int(task_status) == int(HTTPStatus.OK) for task_status in payload)
+
+    # The un-flattened Map state output keeps every download lambda's tasks in
+    # their own batch
+    batches: list[list[CompletedTask]] = (
+        payload if isinstance(payload[0], list) else [payload]
+    )
+    summary = summarise(batches)
+    if EMIT_EMF_METRICS:
+        # Lambda forwards stdout to CloudWatch logs, which extracts the metrics
+        print(json.dumps(emf_metrics(summary)))
+    return summary
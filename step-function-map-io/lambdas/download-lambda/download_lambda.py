@@ -5,14 +5,24 @@ __version__ = ""
 
 import os
 import asyncio
+import contextlib
 import logging
 import json
+import math
+import random
+import time
 import urllib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import partial
 from http import HTTPStatus
-from typing import Any, Callable, NamedTuple, Final, TypedDict
+from typing import Any, AsyncIterator, Callable, NamedTuple, Final, TypedDict
 
 import boto3
 import httpx
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 
 POP20_CC = list(
@@ -31,9 +41,112 @@ BASE_URL = "https://www.fluentpython.com/data/flags"
 DEFAULT_CONCUR_REQ = 5
 MAX_CONCUR_REQ = 1000
 
-S3_CLIENT: Final[Any] = boto3.client("s3")
+# In "fixed" mode every request shares a single pool of concur_req slots. In
+# "adaptive" mode each host gets its own limit which starts at
+# DEFAULT_CONCUR_REQ, grows additively while the host responds quickly and is
+# cut multiplicatively when the host throttles us.
+FIXED_CONCURRENCY_MODE = "fixed"
+ADAPTIVE_CONCURRENCY_MODE = "adaptive"
+CONCURRENCY_MODE: Final[str] = (
+    os.getenv("CONCURRENCY_MODE") or FIXED_CONCURRENCY_MODE
+).lower()
+# Status codes a host uses to tell us to slow down
+THROTTLE_STATUS_CODES: Final[frozenset[int]] = frozenset(
+    {HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE}
+)
+# Stop ramping up once latency exceeds this multiple of the fastest response
+# seen from the host
+DEFAULT_LATENCY_TOLERANCE = 2.0
+ADAPTIVE_LATENCY_TOLERANCE: Final[float] = float(
+    os.getenv("ADAPTIVE_LATENCY_TOLERANCE") or DEFAULT_LATENCY_TOLERANCE
+)
+ADAPTIVE_BACKOFF_FACTOR: Final[float] = 0.5
+
+# Failed requests with one of these status codes, or that never received a
+# response, are retried after an exponential backoff with full jitter
+DEFAULT_RETRY_STATUS_CODES = "408,429,500,502,503,504"
+RETRY_STATUS_CODES: Final[frozenset[int]] = frozenset(
+    int(status_code)
+    for status_code in (
+        os.getenv("RETRY_STATUS_CODES") or DEFAULT_RETRY_STATUS_CODES
+    ).split(",")
+    if status_code.strip()
+)
+DEFAULT_RETRY_MAX_ATTEMPTS = 3
+RETRY_MAX_ATTEMPTS: Final[int] = max(
+    int(os.getenv("RETRY_MAX_ATTEMPTS") or DEFAULT_RETRY_MAX_ATTEMPTS), 1
+)
+RETRY_BASE_DELAY: Final[float] = float(os.getenv("RETRY_BASE_DELAY") or 0.2)
+RETRY_MAX_DELAY: Final[float] = float(os.getenv("RETRY_MAX_DELAY") or 10.0)
+
+# When set, a second GET is fired for any request still outstanding after
+# this percentile of recently observed latencies, the first response wins.
+# Set to 0 to disable hedging.
+HEDGE_PERCENTILE: Final[float] = float(os.getenv("HEDGE_PERCENTILE") or 0)
+# The number of latency samples needed before hedging kicks in
+HEDGE_MIN_SAMPLES: Final[int] = int(os.getenv("HEDGE_MIN_SAMPLES") or 20)
+
+# Uploads are drained from a bounded queue by a dedicated pool of writer
+# threads, once the queue fills up downloads pause until the writers catch up
+DEFAULT_UPLOAD_WORKERS = 10
+UPLOAD_WORKERS: Final[int] = max(
+    int(os.getenv("UPLOAD_WORKERS") or DEFAULT_UPLOAD_WORKERS), 1
+)
+UPLOAD_QUEUE_SIZE: Final[int] = max(
+    int(os.getenv("UPLOAD_QUEUE_SIZE") or 2 * UPLOAD_WORKERS), 1
+)
+
+# Size the connection pool so every writer thread can hold its own connection
+S3_CLIENT: Final[Any] = boto3.client(
+    "s3", config=Config(max_pool_connections=UPLOAD_WORKERS)
+)
 IMAGES_BUCKET_NAME = os.getenv("IMAGES_BUCKET_NAME")
 
+# In "buffered" mode each resource is read fully into memory before being
+# uploaded. In "streaming" mode response chunks are piped straight into an s3
+# multipart upload so memory stays flat regardless of the resource size.
+BUFFERED_UPLOAD_MODE = "buffered"
+STREAMING_UPLOAD_MODE = "streaming"
+UPLOAD_MODE: Final[str] = (os.getenv("UPLOAD_MODE") or BUFFERED_UPLOAD_MODE).lower()
+
+# S3 requires every part of a multipart upload, except the last, to be at
+# least 5MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MULTIPART_PART_SIZE: Final[int] = max(
+    int(os.getenv("MULTIPART_PART_SIZE") or DEFAULT_PART_SIZE), MIN_PART_SIZE
+)
+# The number of parts a single stream may hold in memory while waiting for
+# earlier parts to finish uploading
+DEFAULT_BUFFERED_PARTS = 2
+MULTIPART_BUFFERED_PARTS: Final[int] = max(
+    int(os.getenv("MULTIPART_BUFFERED_PARTS") or DEFAULT_BUFFERED_PARTS), 1
+)
+
+# In incremental mode the origin's ETag and Last-Modified headers are stored
+# as metadata on each s3 object. Later runs send them back as a conditional GET
+# and skip the upload entirely when the origin replies with 304 Not Modified.
+INCREMENTAL_MODE: Final[bool] = (
+    os.getenv("INCREMENTAL_MODE") or ""
+).lower() == "true"
+ETAG_METADATA_KEY = "origin-etag"
+LAST_MODIFIED_METADATA_KEY = "origin-last-modified"
+
+# The http client and its connection pool are kept at the module level so
+# warm invocations can reuse connections, and their TLS sessions, opened by
+# earlier invocations. By default the pool is sized to the batch's concurrency.
+HTTP2_ENABLED: Final[bool] = (os.getenv("HTTP2_ENABLED") or "").lower() == "true"
+HTTP_MAX_CONNECTIONS: Final[int] = int(os.getenv("HTTP_MAX_CONNECTIONS") or 0)
+HTTP_MAX_KEEPALIVE_CONNECTIONS: Final[int] = int(
+    os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS") or 0
+)
+# Lambda environments are frozen between invocations, keep idle connections
+# around long enough to bridge the gap between the Map state's iterations
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+HTTP_KEEPALIVE_EXPIRY: Final[float] = float(
+    os.getenv("HTTP_KEEPALIVE_EXPIRY") or DEFAULT_KEEPALIVE_EXPIRY
+)
+
 
 class BatchPayload(TypedDict):
     baseUrl: str
@@ -49,12 +162,29 @@ class CompletedTaskError(NamedTuple):
     url: str
     statusCode: int
     message: str
+    # Bytes received from the origin, seconds spent across every attempt
+    # and the number of attempts made
+    contentLength: int = 0
+    elapsed: float = 0.0
+    attempts: int = 1
 
 
 class CompletedTaskSuccess(NamedTuple):
     url: str
     statusCode: int
     filename: str
+    # Set when the stored object was already up to date with the origin
+    notModified: bool = False
+    contentLength: int = 0
+    elapsed: float = 0.0
+    attempts: int = 1
+
+
+class FetchResult(NamedTuple):
+    modified: bool
+    contentLength: int
+    # Resolves once the upload queued for a buffered download has finished
+    upload: asyncio.Future | None = None
 
 
 CompletedTask = CompletedTaskError | CompletedTaskSuccess
@@ -64,8 +194,456 @@ class Event(TypedDict):
     Payload: InputPayload
 
 
-def save_resource(img: bytes, filename: str) -> None:
-    S3_CLIENT.put_object(Body=img, Bucket=IMAGES_BUCKET_NAME, Key=filename)
+class UploadJob(NamedTuple):
+    func: Callable[..., Any]
+    kwargs: dict[str, Any]
+    result: asyncio.Future
+
+
+class ConnectionStats:
+    """
+    Counts requests against the connections opened to serve them, using the
+    httpcore trace extension.
+    """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+
+    async def attach(self, request: httpx.Request) -> None:
+        self.requests += 1
+        request.extensions["trace"] = self.trace
+
+    async def trace(self, event_name: str, _: dict[str, Any]) -> None:
+        match event_name:
+            case "connection.connect_tcp.complete":
+                self.connections += 1
+            case "connection.start_tls.complete":
+                self.tls_handshakes += 1
+
+    def snapshot(self) -> tuple[int, int, int]:
+        return self.requests, self.connections, self.tls_handshakes
+
+    def summary(self, since: tuple[int, int, int] = (0, 0, 0)) -> dict[str, Any]:
+        requests, connections, tls_handshakes = (
+            current - previous for current, previous in zip(self.snapshot(), since)
+        )
+        return {
+            "requests": requests,
+            "connections": connections,
+            "tlsHandshakes": tls_handshakes,
+            "reuseRatio": round(1 - connections / requests, 3) if requests else 0.0,
+        }
+
+
+CONNECTION_STATS: Final[ConnectionStats] = ConnectionStats()
+
+_event_loop: asyncio.AbstractEventLoop | None = None
+_http_client: httpx.AsyncClient | None = None
+_http_client_pool_size = 0
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    # The pooled connections belong to the loop that opened them, so the same
+    # loop has to be used for every invocation
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop
+
+
+async def get_http_client(concur_req: int) -> httpx.AsyncClient:
+    global _http_client, _http_client_pool_size
+    pool_size = max(concur_req, HTTP_MAX_CONNECTIONS)
+    if _http_client is not None and pool_size <= _http_client_pool_size:
+        return _http_client
+    if _http_client is not None:
+        # A later batch asked for more concurrency than the pool allows
+        await _http_client.aclose()
+    _http_client = httpx.AsyncClient(
+        timeout=60,
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS or pool_size,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        event_hooks={"request": [CONNECTION_STATS.attach]},
+    )
+    _http_client_pool_size = pool_size
+    return _http_client
+
+
+class S3WriterPool:
+    """
+    Runs blocking s3 calls on a dedicated thread pool. Jobs are placed on a
+    bounded queue and drained by a fixed number of writers, so callers are
+    held up in enqueue when the writers fall behind.
+    """
+
+    def __init__(self, workers: int, queue_size: int) -> None:
+        self._queue: asyncio.Queue[UploadJob | None] = asyncio.Queue(
+            maxsize=queue_size
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="s3-writer"
+        )
+        self._workers = workers
+        self._writers: list[asyncio.Task] = []
+
+    async def __aenter__(self) -> "S3WriterPool":
+        self._writers = [
+            asyncio.create_task(self._write()) for _ in range(self._workers)
+        ]
+        return self
+
+    async def __aexit__(self, *_: Any) -> None:
+        for _ in self._writers:
+            await self._queue.put(None)
+        await asyncio.gather(*self._writers)
+        self._executor.shutdown(wait=True)
+
+    async def enqueue(
+        self, func: Callable[..., Any], /, **kwargs: Any
+    ) -> asyncio.Future:
+        result = asyncio.get_running_loop().create_future()
+        await self._queue.put(UploadJob(func=func, kwargs=kwargs, result=result))
+        return result
+
+    async def run(self, func: Callable[..., Any], /, **kwargs: Any) -> Any:
+        return await (await self.enqueue(func, **kwargs))
+
+    async def _write(self) -> None:
+        loop = asyncio.get_running_loop()
+        while (job := await self._queue.get()) is not None:
+            if job.result.cancelled():
+                continue
+            try:
+                result = await loop.run_in_executor(
+                    self._executor, partial(job.func, **job.kwargs)
+                )
+            except Exception as exc:
+                if not job.result.done():
+                    job.result.set_exception(exc)
+            else:
+                if not job.result.done():
+                    job.result.set_result(result)
+
+
+def retry_delay(attempt: int, retry_after: float = 0.0) -> float:
+    backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return max(random.uniform(0, backoff), min(retry_after, RETRY_MAX_DELAY))
+
+
+class LatencyTracker:
+    """
+    Keeps a window of recent request latencies to decide when a request has
+    taken long enough to be worth hedging.
+    """
+
+    def __init__(self, percentile: float, min_samples: int, window: int = 1000):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.samples: deque[float] = deque(maxlen=window)
+        self.hedged = 0
+        self._threshold: float | None = None
+        self._stale = 0
+
+    def record(self, latency: float) -> None:
+        self.samples.append(latency)
+        self._stale += 1
+
+    def hedge_delay(self) -> float | None:
+        if self.percentile <= 0 or len(self.samples) < self.min_samples:
+            return None
+        # Re-sorting on every request is wasteful, refresh every so often
+        if self._threshold is None or self._stale >= self.min_samples:
+            ordered = sorted(self.samples)
+            index = min(
+                int(len(ordered) * self.percentile / 100), len(ordered) - 1
+            )
+            self._threshold = ordered[index]
+            self._stale = 0
+        return self._threshold
+
+
+LATENCIES: Final[LatencyTracker] = LatencyTracker(
+    HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES
+)
+
+
+def retry_after_seconds(response: httpx.Response) -> float:
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return 0.0
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class HostLimiter:
+    """
+    An AIMD limit on the number of in flight requests made to a single host.
+    """
+
+    def __init__(self, initial: int, maximum: int, adaptive: bool) -> None:
+        self.limit: float = float(min(initial, maximum))
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.in_flight = 0
+        self.min_latency = math.inf
+        self.resume_at = 0.0
+        self.last_backoff = -math.inf
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        async with self._condition:
+            while True:
+                # Honour any Retry-After given by the host before sending more
+                delay = self.resume_at - loop.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), delay)
+                    except TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                await self._condition.wait()
+
+    async def release(
+        self, latency: float, throttled: bool, retry_after: float = 0.0
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        async with self._condition:
+            self.in_flight -= 1
+            if self.adaptive and throttled:
+                # Responses to requests sent before the last backoff would
+                # otherwise cut the limit again for the same congestion event
+                if loop.time() - self.last_backoff > min(self.min_latency, 1.0):
+                    self.limit = max(1.0, self.limit * ADAPTIVE_BACKOFF_FACTOR)
+                    self.last_backoff = loop.time()
+                # A host asking for a longer pause can't stall the whole batch
+                self.resume_at = max(
+                    self.resume_at, loop.time() + min(retry_after, RETRY_MAX_DELAY)
+                )
+            elif self.adaptive and latency > 0:
+                self.min_latency = min(self.min_latency, latency)
+                if latency <= self.min_latency * ADAPTIVE_LATENCY_TOLERANCE:
+                    # Grows by roughly one slot for every limit responses
+                    self.limit = min(
+                        float(self.maximum), self.limit + 1 / int(self.limit)
+                    )
+            self._condition.notify_all()
+
+
+class LimiterSlot:
+    def __init__(self, host_limiter: HostLimiter) -> None:
+        self.host_limiter = host_limiter
+        self.started = 0.0
+        self.response_time: float | None = None
+
+    async def __aenter__(self) -> "LimiterSlot":
+        await self.host_limiter.acquire()
+        self.started = time.perf_counter()
+        return self
+
+    def responded(self) -> None:
+        # The slot may be held after the response arrives, while its upload is
+        # queued or streamed, which says nothing about the host's load
+        self.response_time = time.perf_counter() - self.started
+
+    async def __aexit__(self, exc_type: Any, exc: Any, _: Any) -> None:
+        latency = (
+            self.response_time
+            if self.response_time is not None
+            else time.perf_counter() - self.started
+        )
+        throttled = False
+        retry_after = 0.0
+        if isinstance(exc, httpx.HTTPStatusError):
+            throttled = exc.response.status_code in THROTTLE_STATUS_CODES
+            retry_after = retry_after_seconds(exc.response)
+            # Other error statuses say nothing about the host's capacity
+            latency = latency if throttled else 0.0
+        elif isinstance(exc, httpx.TimeoutException):
+            throttled = True
+        elif exc is not None:
+            latency = 0.0
+        await self.host_limiter.release(latency, throttled, retry_after)
+
+
+class ConcurrencyLimiter:
+    """
+    Hands out request slots per host. When not adaptive all hosts share a
+    single fixed limit, behaving like a plain semaphore.
+    """
+
+    def __init__(self, initial: int, maximum: int, adaptive: bool) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.host_limiters: dict[str, HostLimiter] = {}
+
+    def slot(self, url: str) -> LimiterSlot:
+        host = urllib.parse.urlparse(url).netloc if self.adaptive else ""
+        if host not in self.host_limiters:
+            self.host_limiters[host] = HostLimiter(
+                self.initial, self.maximum, self.adaptive
+            )
+        return LimiterSlot(self.host_limiters[host])
+
+
+def save_resource(
+    img: bytes, filename: str, metadata: dict[str, str] | None = None
+) -> None:
+    S3_CLIENT.put_object(
+        Body=img, Bucket=IMAGES_BUCKET_NAME, Key=filename, Metadata=metadata or {}
+    )
+
+
+def get_saved_metadata(filename: str) -> dict[str, str]:
+    try:
+        head_response = S3_CLIENT.head_object(Bucket=IMAGES_BUCKET_NAME, Key=filename)
+    except ClientError as exc:
+        if exc.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return {}
+        raise
+    return head_response.get("Metadata", {})
+
+
+def origin_metadata(headers: httpx.Headers) -> dict[str, str]:
+    metadata: dict[str, str] = {}
+    if etag := headers.get("ETag"):
+        metadata[ETAG_METADATA_KEY] = etag
+    if last_modified := headers.get("Last-Modified"):
+        metadata[LAST_MODIFIED_METADATA_KEY] = last_modified
+    return metadata
+
+
+def conditional_headers(metadata: dict[str, str]) -> dict[str, str]:
+    headers: dict[str, str] = {}
+    if etag := metadata.get(ETAG_METADATA_KEY):
+        headers["If-None-Match"] = etag
+    if last_modified := metadata.get(LAST_MODIFIED_METADATA_KEY):
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+async def iter_parts(
+    chunks: AsyncIterator[bytes], part_size: int
+) -> AsyncIterator[bytes]:
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer.extend(chunk)
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+async def save_resource_stream(
+    chunks: AsyncIterator[bytes],
+    filename: str,
+    writer: S3WriterPool,
+    metadata: dict[str, str] | None = None,
+) -> None:
+    parts = iter_parts(chunks, MULTIPART_PART_SIZE)
+    first_part = await anext(parts, None)
+    second_part = await anext(parts, None)
+
+    if second_part is None:
+        # Resources that fit into a single part don't benefit from a multipart
+        # upload, just put them as is
+        await writer.run(
+            save_resource,
+            img=first_part or b"",
+            filename=filename,
+            metadata=metadata,
+        )
+        return
+
+    create_response = await writer.run(
+        S3_CLIENT.create_multipart_upload,
+        Bucket=IMAGES_BUCKET_NAME,
+        Key=filename,
+        Metadata=metadata or {},
+    )
+    upload_id: str = create_response["UploadId"]
+    # Bound the number of parts waiting to be uploaded, the download will
+    # pause once this queue fills up
+    part_queue: asyncio.Queue[tuple[int, bytes] | None] = asyncio.Queue(
+        maxsize=MULTIPART_BUFFERED_PARTS
+    )
+
+    async def upload_parts() -> list[dict[str, Any]]:
+        completed_parts: list[dict[str, Any]] = []
+        while (item := await part_queue.get()) is not None:
+            part_number, body = item
+            upload_response = await writer.run(
+                S3_CLIENT.upload_part,
+                Body=body,
+                Bucket=IMAGES_BUCKET_NAME,
+                Key=filename,
+                UploadId=upload_id,
+                PartNumber=part_number,
+            )
+            completed_parts.append(
+                {"ETag": upload_response["ETag"], "PartNumber": part_number}
+            )
+        return completed_parts
+
+    uploader = asyncio.create_task(upload_parts())
+
+    async def enqueue(item: tuple[int, bytes] | None) -> None:
+        # Stop waiting on a full queue if the uploader has already failed
+        put = asyncio.ensure_future(part_queue.put(item))
+        await asyncio.wait({put, uploader}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            uploader.result()
+
+    try:
+        await enqueue((1, first_part))
+        await enqueue((2, second_part))
+        part_number = 3
+        async for body in parts:
+            await enqueue((part_number, body))
+            part_number += 1
+        await enqueue(None)
+        completed_parts = await uploader
+        await writer.run(
+            S3_CLIENT.complete_multipart_upload,
+            Bucket=IMAGES_BUCKET_NAME,
+            Key=filename,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": completed_parts},
+        )
+    except BaseException:
+        uploader.cancel()
+        await writer.run(
+            S3_CLIENT.abort_multipart_upload,
+            Bucket=IMAGES_BUCKET_NAME,
+            Key=filename,
+            UploadId=upload_id,
+        )
+        raise
+
+
+def resource_url(base_url: str, resource: str) -> str:
+    # Resources may also be given as absolute urls on other hosts
+    if urllib.parse.urlparse(resource).scheme:
+        return resource
+    return f"{base_url}/{resource}"
 
 
 def filename_from_url(url: str):
@@ -75,57 +653,248 @@ def filename_from_url(url: str):
     return f"{domain}/{resource_filename}"
 
 
-async def get_resource(client: httpx.AsyncClient, url: str) -> bytes:
-    resp = await client.get(url, timeout=10, follow_redirects=True)
-    resp.raise_for_status()
-    return resp.content
+async def fetch_resource(
+    client: httpx.AsyncClient, url: str, headers: dict[str, str]
+) -> httpx.Response:
+    resp = await client.get(url, headers=headers, timeout=10, follow_redirects=True)
+    if resp.status_code != HTTPStatus.NOT_MODIFIED:
+        resp.raise_for_status()
+    return resp
+
+
+async def fetch_resource_in_slot(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: dict[str, str],
+    limiter: ConcurrencyLimiter,
+) -> httpx.Response:
+    async with limiter.slot(url):
+        return await fetch_resource(client, url, headers)
+
+
+async def fetch_resource_hedged(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: dict[str, str],
+    hedge_delay: float,
+    limiter: ConcurrencyLimiter,
+) -> httpx.Response:
+    primary = asyncio.create_task(fetch_resource(client, url, headers))
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+        if done:
+            return primary.result()
+        LATENCIES.hedged += 1
+        # The hedged request counts against the host's limit like any other, so
+        # it waits for a free slot
+        pending.add(
+            asyncio.create_task(fetch_resource_in_slot(client, url, headers, limiter))
+        )
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        # Both requests failed, report the error from the original request
+        return primary.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        # Let a cancelled hedge hand its slot back before carrying on
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def get_resource(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: dict[str, str] | None = None,
+    limiter: ConcurrencyLimiter | None = None,
+) -> httpx.Response:
+    started = time.perf_counter()
+    hedge_delay = LATENCIES.hedge_delay()
+    # Requests are only hedged when there is a limiter to take a slot from
+    if hedge_delay is None or limiter is None:
+        resp = await fetch_resource(client, url, headers or {})
+    else:
+        resp = await fetch_resource_hedged(
+            client, url, headers or {}, hedge_delay, limiter
+        )
+    LATENCIES.record(time.perf_counter() - started)
+    return resp
+
+
+async def stream_resource(
+    client: httpx.AsyncClient,
+    url: str,
+    filename: str,
+    writer: S3WriterPool,
+    headers: dict[str, str] | None = None,
+    slot: LimiterSlot | None = None,
+) -> FetchResult:
+    async with client.stream(
+        "GET", url, headers=headers, timeout=10, follow_redirects=True
+    ) as resp:
+        # The body is read as fast as it can be uploaded, so only the time to
+        # the response headers is the host's
+        if slot is not None:
+            slot.responded()
+        if resp.status_code == HTTPStatus.NOT_MODIFIED:
+            return FetchResult(modified=False, contentLength=0)
+        resp.raise_for_status()
+        await save_resource_stream(
+            resp.aiter_bytes(), filename, writer, origin_metadata(resp.headers)
+        )
+    return FetchResult(modified=True, contentLength=resp.num_bytes_downloaded)
+
+
+async def fetch_and_save(
+    client: httpx.AsyncClient,
+    url: str,
+    filename: str,
+    limiter: ConcurrencyLimiter,
+    writer: S3WriterPool,
+    headers: dict[str, str],
+) -> FetchResult:
+    async with limiter.slot(url) as slot:
+        if UPLOAD_MODE == STREAMING_UPLOAD_MODE:
+            # The upload overlaps the download, so there is nothing left
+            # to save once the stream has been consumed
+            return await stream_resource(client, url, filename, writer, headers, slot)
+        resp = await get_resource(client, url, headers, limiter)
+        slot.responded()
+        if resp.status_code == HTTPStatus.NOT_MODIFIED:
+            return FetchResult(modified=False, contentLength=0)
+        # Hold onto the download slot until the upload has been queued so
+        # downloads pause whenever the writers fall behind
+        upload = await writer.enqueue(
+            save_resource,
+            img=resp.content,
+            filename=filename,
+            metadata=origin_metadata(resp.headers),
+        )
+        return FetchResult(
+            modified=True, contentLength=resp.num_bytes_downloaded, upload=upload
+        )
 
 
 async def download_one(
     client: httpx.AsyncClient,
     resource: str,
     base_url: str,
-    semaphore: asyncio.Semaphore,
+    limiter: ConcurrencyLimiter,
+    writer: S3WriterPool,
 ) -> CompletedTask:
-    url = f"{base_url}/{resource}"
-    try:
-        async with semaphore:
-            image = await get_resource(client, url)
-    except httpx.HTTPStatusError as exc:
-        response = exc.response
-        status_code = response.status_code
-        match status_code:
-            case HTTPStatus.NOT_FOUND:
-                message = f"Could not find: {response.url}"
-            case _:
-                message = (
-                    f"HTTP error {response.status_code} - {response.reason_phrase}"
-                )
-    except httpx.RequestError as exc:
-        status_code = 400
-        message = f"{exc} {type(exc)}".strip()
-    else:
-        filename = filename_from_url(url)
-        await asyncio.to_thread(save_resource, image, filename)
-        status_code = int(HTTPStatus.OK)
-        return CompletedTaskSuccess(url=url, statusCode=status_code, filename=filename)
-
-    return CompletedTaskError(url=url, statusCode=int(status_code), message=message)
+    url = resource_url(base_url, resource)
+    filename = filename_from_url(url)
+    started = time.perf_counter()
+    headers: dict[str, str] = {}
+    if INCREMENTAL_MODE:
+        headers = conditional_headers(
+            await writer.run(get_saved_metadata, filename=filename)
+        )
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+        retries_left = attempt < RETRY_MAX_ATTEMPTS
+        try:
+            fetched = await fetch_and_save(
+                client, url, filename, limiter, writer, headers
+            )
+        except httpx.HTTPStatusError as exc:
+            response = exc.response
+            status_code = response.status_code
+            retry_after = retry_after_seconds(response)
+            # Give up rather than wait longer than RETRY_MAX_DELAY
+            if (
+                retries_left
+                and status_code in RETRY_STATUS_CODES
+                and retry_after <= RETRY_MAX_DELAY
+            ):
+                await asyncio.sleep(retry_delay(attempt, retry_after))
+                continue
+            match status_code:
+                case HTTPStatus.NOT_FOUND:
+                    message = f"Could not find: {response.url}"
+                case _:
+                    message = (
+                        f"HTTP error {response.status_code} - {response.reason_phrase}"
+                    )
+        except httpx.RequestError as exc:
+            if retries_left:
+                await asyncio.sleep(retry_delay(attempt))
+                continue
+            status_code = 400
+            message = f"{exc} {type(exc)}".strip()
+        else:
+            if fetched.upload is not None:
+                await fetched.upload
+            status_code = int(HTTPStatus.OK)
+            return CompletedTaskSuccess(
+                url=url,
+                statusCode=status_code,
+                filename=filename,
+                notModified=not fetched.modified,
+                contentLength=fetched.contentLength,
+                elapsed=round(time.perf_counter() - started, 4),
+                attempts=attempt,
+            )
+        break
+
+    return CompletedTaskError(
+        url=url,
+        statusCode=int(status_code),
+        message=message,
+        elapsed=round(time.perf_counter() - started, 4),
+        attempts=attempt,
+    )
 
 
 async def supervisor(
-    resource_list: list[str], base_url: str, concur_req: int
+    resource_list: list[str],
+    base_url: str,
+    concur_req: int,
+    transport: httpx.AsyncBaseTransport | None = None,
 ) -> list[CompletedTask]:
     completed_tasks: list[CompletedTask] = []
-    semaphore = asyncio.Semaphore(concur_req)
-    async with httpx.AsyncClient(timeout=60) as client:
+    if CONCURRENCY_MODE == ADAPTIVE_CONCURRENCY_MODE:
+        limiter = ConcurrencyLimiter(DEFAULT_CONCUR_REQ, concur_req, adaptive=True)
+    else:
+        limiter = ConcurrencyLimiter(concur_req, concur_req, adaptive=False)
+    async with contextlib.AsyncExitStack() as stack:
+        if transport is None:
+            client = await get_http_client(concur_req)
+        else:
+            client = await stack.enter_async_context(
+                httpx.AsyncClient(
+                    timeout=60,
+                    transport=transport,
+                    event_hooks={"request": [CONNECTION_STATS.attach]},
+                )
+            )
+        writer = await stack.enter_async_context(
+            S3WriterPool(UPLOAD_WORKERS, UPLOAD_QUEUE_SIZE)
+        )
         to_do = [
-            download_one(client, resource, base_url, semaphore)
+            asyncio.create_task(
+                download_one(client, resource, base_url, limiter, writer)
+            )
             for resource in sorted(resource_list)
         ]
-        for corountine in asyncio.as_completed(to_do):
-            task_status = await corountine
-            completed_tasks.append(task_status)
+        try:
+            for corountine in asyncio.as_completed(to_do):
+                task_status = await corountine
+                completed_tasks.append(task_status)
+        finally:
+            # The event loop outlives the invocation, so downloads left behind
+            # by an error would otherwise carry on into the next one
+            for task in to_do:
+                task.cancel()
+            await asyncio.gather(*to_do, return_exceptions=True)
+
+    if LATENCIES.hedged:
+        logger: logging.Logger = logging.getLogger(__name__)
+        logger.info(f"Hedged {LATENCIES.hedged} requests so far")
 
     return completed_tasks
 
@@ -136,7 +905,9 @@ def download_many(
     concur_req: int,
 ) -> list[CompletedTask]:
     corountine = supervisor(resource_list, base_url, concur_req)
-    completed_tasks: list[CompletedTask] = asyncio.run(corountine)
+    completed_tasks: list[CompletedTask] = get_event_loop().run_until_complete(
+        corountine
+    )
 
     return completed_tasks
 
@@ -152,6 +923,10 @@ def download_images(
     logger.setLevel(logging.INFO)
 
     actual_concur_req = min(default_concur_req, max_concur_req)
+    if CONCURRENCY_MODE == ADAPTIVE_CONCURRENCY_MODE:
+        # The adaptive limiter starts from the default itself and may ramp up
+        # as far as the requested maximum
+        actual_concur_req = min(max_concur_req, MAX_CONCUR_REQ)
     return downloader(
         resources,
         base_url,
@@ -169,6 +944,8 @@ def handler(payload: InputPayload, _: Any) -> list[dict[str, Any]]:
     logger.info("Payload:")
     logger.info(json.dumps(payload))
 
+    warm_start = _http_client is not None
+    connection_stats = CONNECTION_STATS.snapshot()
     completed_tasks = download_images(
         download_many,
         DEFAULT_CONCUR_REQ,
@@ -177,6 +954,15 @@ def handler(payload: InputPayload, _: Any) -> list[dict[str, Any]]:
         payload["batchInput"]["baseUrl"],
     )
     logger.info(json.dumps(completed_tasks))
+    logger.info(
+        json.dumps(
+            {
+                "warmStart": warm_start,
+                "invocation": CONNECTION_STATS.summary(connection_stats),
+                "lifetime": CONNECTION_STATS.summary(),
+            }
+        )
+    )
 
     return [task._asdict() for task in completed_tasks]
 
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Simulates the Map state running the download lambda over batches produced by
+each of the batch lambda's partition strategies and reports the makespan, the
+time until the last batch finishes.
+
+    python scripts/benchmark_partition.py --resources 2000 --hosts 3
+"""
+
+__author__ = "Michael Ciccotosto-Camp"
+__version__ = ""
+
+import os
+import sys
+import argparse
+import heapq
+import random
+import statistics
+import urllib.parse
+from typing import Any
+
+BASE_URL = "https://origin-0.example.com/data"
+
+
+def generate_resources(
+    count: int, hosts: int, seed: int
+) -> tuple[list[str], dict[str, int]]:
+    rng = random.Random(seed)
+    resource_paths: list[str] = []
+    sizes: dict[str, int] = {}
+    for index in range(count):
+        host = rng.randrange(hosts)
+        # Resources on the base url's host are given as relative paths
+        resource_path = (
+            f"r{index}.gif"
+            if host == 0
+            else f"https://origin-{host}.example.com/data/r{index}.gif"
+        )
+        # Most resources are small but a few are very large
+        sizes[resource_path] = int(rng.lognormvariate(ARGS.size_mu, ARGS.size_sigma))
+        resource_paths.append(resource_path)
+    return resource_paths, sizes
+
+
+def batch_duration(batch: list[str], sizes: dict[str, int]) -> float:
+    # Each of the lambda's download slots works through the batch in order,
+    # opening a new connection whenever it moves onto a different host
+    slots: list[tuple[float, int, str]] = [
+        (0.0, slot, "") for slot in range(ARGS.lambda_concur)
+    ]
+    heapq.heapify(slots)
+    finished = 0.0
+    for resource_path in batch:
+        started, slot, connected_host = heapq.heappop(slots)
+        host = urllib.parse.urlparse(
+            batch_lambda.resource_url(BASE_URL, resource_path)
+        ).netloc
+        duration = ARGS.latency + sizes[resource_path] / ARGS.bandwidth
+        if host != connected_host:
+            duration += ARGS.connect_time
+        finished = max(finished, started + duration)
+        heapq.heappush(slots, (started + duration, slot, host))
+    return ARGS.invoke_overhead + finished
+
+
+def makespan(durations: list[float]) -> float:
+    # The Map state starts the next batch as soon as one of its lambdas frees up
+    lambdas = [0.0] * ARGS.map_concurrency
+    for duration in durations:
+        heapq.heapreplace(lambdas, lambdas[0] + duration)
+    return max(lambdas)
+
+
+def main() -> None:
+    # Tell the batch lambda how long a request takes in terms of bytes so its
+    # cost estimates line up with the simulation
+    os.environ["REQUEST_OVERHEAD_BYTES"] = str(
+        int((ARGS.latency + ARGS.connect_time) * ARGS.bandwidth)
+    )
+    sys.path.insert(
+        0, os.path.join(os.path.dirname(__file__), "..", "lambdas", "batch-lambda")
+    )
+    global batch_lambda
+    import batch_lambda
+
+    resource_paths, sizes = generate_resources(ARGS.resources, ARGS.hosts, ARGS.seed)
+    payload: Any = {
+        "baseUrl": BASE_URL,
+        "lambdaConcur": str(ARGS.lambda_concur),
+        "resourcePaths": resource_paths,
+        "resourceSizes": sizes,
+    }
+
+    print(
+        f"{'strategy':>9} {'batches':>8} {'makespan':>9} "
+        f"{'mean':>7} {'max':>7} {'speedup':>8}"
+    )
+    baseline = None
+    for strategy in (
+        batch_lambda.FIXED_PARTITION_STRATEGY,
+        batch_lambda.BALANCED_PARTITION_STRATEGY,
+        batch_lambda.HOST_PARTITION_STRATEGY,
+    ):
+        batches = batch_lambda.partition_resources(payload, strategy)
+        durations = [batch_duration(batch, sizes) for batch in batches]
+        total = makespan(durations)
+        baseline = baseline or total
+        print(
+            f"{strategy:>9} {len(batches):>8} {total:>9.2f} "
+            f"{statistics.mean(durations):>7.2f} {max(durations):>7.2f} "
+            f"{baseline / total:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--resources", type=int, default=2000)
+    parser.add_argument("--hosts", type=int, default=3)
+    parser.add_argument("--lambda-concur", type=int, default=5)
+    parser.add_argument("--map-concurrency", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--connect-time", type=float, default=0.1, help="seconds")
+    parser.add_argument(
+        "--bandwidth", type=float, default=5e6, help="bytes per second"
+    )
+    parser.add_argument("--invoke-overhead", type=float, default=0.05, help="seconds")
+    parser.add_argument("--size-mu", type=float, default=12.0)
+    parser.add_argument("--size-sigma", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=0)
+    ARGS = parser.parse_args()
+    main()
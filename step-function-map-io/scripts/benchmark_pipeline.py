@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""
+Runs the batch, download and consolidate lambdas end to end against a local
+http origin and a local moto server standing in for s3, and reports the
+throughput, latency percentiles and peak memory of the download lambdas.
+
+The Map state is simulated with a process pool, each worker process playing
+the part of one warm lambda environment. Any lambda setting can be passed
+through with --env, so concurrency changes can be compared before deploying.
+
+    pip install -r lambdas/download-lambda/requirements.in "moto[server]"
+    python scripts/benchmark_pipeline.py --resources 500 --map-concurrency 5 \\
+        --env PARTITION_STRATEGY=balanced --env CONCURRENCY_MODE=adaptive
+"""
+
+__author__ = "Michael Ciccotosto-Camp"
+__version__ = ""
+
+import os
+import sys
+import argparse
+import hashlib
+import random
+import resource
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+from benchmark_upload import start_moto_server
+
+BUCKET_NAME = "benchmark-images"
+LAMBDAS_DIR = os.path.join(os.path.dirname(__file__), "..", "lambdas")
+
+
+def resource_rng(path: str) -> random.Random:
+    # Every resource keeps the same size and latency across runs
+    return random.Random(int(hashlib.md5(path.encode()).hexdigest(), 16) + ARGS.seed)
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        rng = resource_rng(self.path)
+        size = int(rng.lognormvariate(ARGS.size_mu, ARGS.size_sigma))
+        latency = rng.lognormvariate(0, ARGS.latency_sigma) * ARGS.latency_ms / 1000
+        # Errors are drawn per request so that retries can succeed
+        failed = random.random() < ARGS.error_rate
+        time.sleep(latency)
+        status = HTTPStatus.SERVICE_UNAVAILABLE if failed else HTTPStatus.OK
+        body = b"" if failed else os.urandom(size)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_: Any) -> None:
+        pass
+
+
+def start_origin(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), OriginHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def init_lambda_environment() -> None:
+    global download_lambda
+    sys.path.insert(0, os.path.join(LAMBDAS_DIR, "download-lambda"))
+    import download_lambda
+
+
+def invoke_download_lambda(task: dict[str, Any]) -> tuple[list[dict], float]:
+    start = time.perf_counter()
+    completed_tasks = download_lambda.handler(task, None)
+    return completed_tasks, time.perf_counter() - start
+
+
+def main() -> None:
+    moto_server = start_moto_server(ARGS.moto_port)
+    origin = start_origin(ARGS.origin_port)
+    os.environ.update(
+        {
+            "AWS_ENDPOINT_URL": f"http://127.0.0.1:{ARGS.moto_port}",
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "IMAGES_BUCKET_NAME": BUCKET_NAME,
+            "MAX_CONCURRENCY": str(ARGS.lambda_concur),
+        }
+    )
+    os.environ.update(env.split("=", 1) for env in ARGS.env)
+    for lambda_dir in ("batch-lambda", "consolidate-lambda"):
+        sys.path.insert(0, os.path.join(LAMBDAS_DIR, lambda_dir))
+    import batch_lambda
+    import consolidate_lambda
+
+    try:
+        batch_lambda.S3_CLIENT.create_bucket(Bucket=BUCKET_NAME)
+        start = time.perf_counter()
+        batches = batch_lambda.handler(
+            {
+                "baseUrl": f"http://127.0.0.1:{ARGS.origin_port}/data",
+                "lambdaConcur": str(ARGS.lambda_concur),
+                "resourcePaths": [
+                    f"r{index}/r{index}.gif" for index in range(ARGS.resources)
+                ],
+            },
+            None,
+        )
+        with ProcessPoolExecutor(
+            ARGS.map_concurrency, initializer=init_lambda_environment
+        ) as executor:
+            results = list(executor.map(invoke_download_lambda, batches["tasks"]))
+        summary = consolidate_lambda.handler(
+            [completed_tasks for completed_tasks, _ in results], None
+        )
+        elapsed = time.perf_counter() - start
+        # Only counts the pool's workers as the moto server is still running
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    finally:
+        origin.shutdown()
+        moto_server.kill()
+
+    invocations = sorted(duration for _, duration in results)
+    print(f"batches            {len(batches['tasks'])}")
+    print(f"resources          {summary['tasks']}")
+    print(f"status codes       {summary['statusCounts']}")
+    print(f"retries            {summary['retries']}")
+    print(f"wall time          {elapsed:.2f} s")
+    print(f"throughput         {summary['tasks'] / elapsed:.1f} resources/s")
+    print(f"                   {summary['bytes'] / elapsed / 1024 / 1024:.2f} MiB/s")
+    print(
+        f"resource latency   p50 {summary['latency']['p50']:.3f} s  "
+        f"p99 {summary['latency']['p99']:.3f} s"
+    )
+    print(
+        f"invocation time    p50 "
+        f"{consolidate_lambda.percentile(invocations, 50):.3f} s  "
+        f"p99 {consolidate_lambda.percentile(invocations, 99):.3f} s"
+    )
+    print(f"peak lambda rss    {peak_rss / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--resources", type=int, default=500)
+    parser.add_argument("--map-concurrency", type=int, default=5)
+    parser.add_argument("--lambda-concur", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--size-mu", type=float, default=10.0)
+    parser.add_argument("--size-sigma", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="environment variable for the lambdas, may be repeated",
+    )
+    parser.add_argument("--origin-port", type=int, default=8000)
+    parser.add_argument("--moto-port", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    ARGS = parser.parse_args()
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+Compares the upload throughput of the download lambda's s3 writer pool against
+funnelling every upload through asyncio.to_thread, using a local moto server as
+an s3 stand-in and an in memory httpx transport as the origin.
+
+    pip install -r lambdas/download-lambda/requirements.in "moto[server]"
+    python scripts/benchmark_upload.py --resources 1000 --size 65536
+"""
+
+__author__ = "Michael Ciccotosto-Camp"
+__version__ = ""
+
+import os
+import sys
+import asyncio
+import argparse
+import subprocess
+import time
+import urllib.request
+from typing import Any
+
+BUCKET_NAME = "benchmark-images"
+CONCURRENCY_LEVELS = (5, 50, 500)
+
+
+async def legacy_download_one(
+    download_lambda: Any,
+    client: Any,
+    resource: str,
+    base_url: str,
+    semaphore: asyncio.Semaphore,
+) -> None:
+    # The upload path used before the writer pool was introduced
+    url = f"{base_url}/{resource}"
+    async with semaphore:
+        resp = await download_lambda.get_resource(client, url)
+    await asyncio.to_thread(
+        download_lambda.save_resource,
+        resp.content,
+        download_lambda.filename_from_url(url),
+    )
+
+
+async def run(
+    download_lambda: Any, resources: list[str], concurrency: int, use_writer: bool
+) -> float:
+    import httpx
+
+    body = os.urandom(ARGS.size)
+    transport = httpx.MockTransport(lambda _: httpx.Response(200, content=body))
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = download_lambda.ConcurrencyLimiter(
+        concurrency, concurrency, adaptive=False
+    )
+    base_url = "http://origin.local"
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport) as client:
+        if use_writer:
+            async with download_lambda.S3WriterPool(
+                download_lambda.UPLOAD_WORKERS, download_lambda.UPLOAD_QUEUE_SIZE
+            ) as writer:
+                await asyncio.gather(
+                    *(
+                        download_lambda.download_one(
+                            client, resource, base_url, limiter, writer
+                        )
+                        for resource in resources
+                    )
+                )
+        else:
+            await asyncio.gather(
+                *(
+                    legacy_download_one(
+                        download_lambda, client, resource, base_url, semaphore
+                    )
+                    for resource in resources
+                )
+            )
+    return time.perf_counter() - start
+
+
+def start_moto_server(port: int) -> subprocess.Popen:
+    # Run moto in its own process so it doesn't compete with the benchmark for
+    # the GIL
+    server = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/moto-api/")
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The moto server did not start")
+
+
+def main() -> None:
+    server = start_moto_server(ARGS.port)
+    os.environ.update(
+        {
+            "AWS_ENDPOINT_URL": f"http://127.0.0.1:{ARGS.port}",
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "IMAGES_BUCKET_NAME": BUCKET_NAME,
+            "UPLOAD_WORKERS": str(ARGS.upload_workers),
+        }
+    )
+    sys.path.insert(
+        0,
+        os.path.join(os.path.dirname(__file__), "..", "lambdas", "download-lambda"),
+    )
+    import download_lambda
+
+    download_lambda.S3_CLIENT.create_bucket(Bucket=BUCKET_NAME)
+    resources = [f"r{index}/r{index}.gif" for index in range(ARGS.resources)]
+    total_mib = ARGS.resources * ARGS.size / (1024 * 1024)
+
+    print(f"{'concurrency':>11} {'mode':>10} {'seconds':>8} {'obj/s':>8} {'MiB/s':>8}")
+    try:
+        for concurrency in CONCURRENCY_LEVELS:
+            for use_writer in (False, True):
+                elapsed = asyncio.run(
+                    run(download_lambda, resources, concurrency, use_writer)
+                )
+                mode = "writer" if use_writer else "to_thread"
+                print(
+                    f"{concurrency:>11} {mode:>10} {elapsed:>8.2f} "
+                    f"{ARGS.resources / elapsed:>8.1f} {total_mib / elapsed:>8.2f}"
+                )
+    finally:
+        server.kill()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--resources", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--upload-workers", type=int, default=50)
+    parser.add_argument("--port", type=int, default=5000)
+    ARGS = parser.parse_args()
+    main()